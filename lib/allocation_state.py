@@ -0,0 +1,156 @@
+"""Remember allocations between runs.
+
+The state file records, for each new slot in the last run, the conflict level
+of everyone who could be assigned to it and the people who were proposed for
+it, along with a fingerprint of each interviewer's calendar.
+
+On the next run, conflict levels are only calculated for slots which weren't
+in the state, and for people whose calendars have changed since.  The people
+proposed last time are assigned first, where they still can be, so that the
+allocator only has to fill the slots which are new or whose panels no longer
+work.
+
+"""
+
+import hashlib
+import json
+import os
+
+from conflict_matrix import ConflictMatrix, UNAVAILABLE, encode_calendar
+
+# Version of the state file format.  State from other versions is ignored.
+state_version = 1
+
+
+def calendar_fingerprint(calendar):
+    """Return a fingerprint of a calendar's events.
+
+    Uses the fingerprint from the calendar cache if there is one, and
+    otherwise hashes the parts of the events which affect conflict levels.
+
+    """
+    if calendar.fingerprint is not None:
+        return calendar.fingerprint
+    digest = hashlib.sha1()
+    for array in encode_calendar(calendar):
+        digest.update(array.tostring())
+    return digest.hexdigest()
+
+
+class AllocationState(object):
+    def __init__(self, calendars=None, slots=None):
+        """The state of an allocation.
+
+        :param calendars: The fingerprint of each interviewer's calendar, by
+        email.
+        :param slots: For each new slot, by start time in ISO format, a dict
+        holding its "end" time, the conflict level of each available person
+        ("costs", by email), and the emails of the people "proposed" for it.
+
+        """
+        self.calendars = calendars if calendars is not None else {}
+        self.slots = slots if slots is not None else {}
+        self.reused = 0
+        self.calculated = 0
+
+    @staticmethod
+    def load(path):
+        """Load the state from a file, or return an empty state if there is
+        no usable state there.
+
+        """
+        if not os.path.exists(path):
+            return AllocationState()
+        with open(path, "rb") as fobj:
+            data = json.load(fobj)
+        if data.get("version") != state_version:
+            print "Ignoring allocation state from version {}".format(
+                data.get("version"))
+            return AllocationState()
+        return AllocationState(data["calendars"], data["slots"])
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as fobj:
+            json.dump({
+                "version": state_version,
+                "calendars": self.calendars,
+                "slots": self.slots,
+            }, fobj, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    def proposed(self, slot):
+        """Return the emails of the people proposed for a slot last time."""
+        data = self.slots.get(slot.start.isoformat())
+        if data is None or data["end"] != slot.end.isoformat():
+            return []
+        return data["proposed"]
+
+    def conflict_levels(self, interviewers, slots):
+        """Return the conflict levels of the available people for each slot.
+
+        Returns a list with a dict for each slot, mapping email to conflict
+        level.  Levels from the state are used for people whose calendars
+        haven't changed; the rest are calculated.
+
+        """
+        changed = []
+        unchanged = []
+        for person in interviewers:
+            if self.calendars.get(person.email) == calendar_fingerprint(
+                    person.calendar):
+                unchanged.append(person)
+            else:
+                changed.append(person)
+
+        result = [{} for slot in slots]
+        if changed:
+            matrix = ConflictMatrix(changed, slots)
+            for row, person in enumerate(changed):
+                for column in range(len(slots)):
+                    level = int(matrix.levels[row, column])
+                    if level != UNAVAILABLE:
+                        result[column][person.email] = level
+            self.calculated += len(changed) * len(slots)
+
+        missing = []
+        for column, slot in enumerate(slots):
+            data = self.slots.get(slot.start.isoformat())
+            if data is not None and data["end"] == slot.end.isoformat():
+                for person in unchanged:
+                    level = data["costs"].get(person.email)
+                    if level is not None:
+                        result[column][person.email] = level
+                self.reused += len(unchanged)
+            else:
+                missing.append(column)
+        if unchanged and missing:
+            matrix = ConflictMatrix(
+                unchanged, [slots[column] for column in missing])
+            for row, person in enumerate(unchanged):
+                for index, column in enumerate(missing):
+                    level = int(matrix.levels[row, index])
+                    if level != UNAVAILABLE:
+                        result[column][person.email] = level
+            self.calculated += len(unchanged) * len(missing)
+        return result
+
+    def update(self, allocator):
+        """Record the state after an allocator has run."""
+        interviewers = allocator.interviewers
+        self.calendars = dict(
+            (person.email, calendar_fingerprint(person.calendar))
+            for person in interviewers
+        )
+        self.slots = {}
+        for assignment in allocator.dropped:
+            self._add_slot(assignment, [])
+        for assignment in allocator.assignments.new_assignments():
+            self._add_slot(assignment, assignment.assigned)
+
+    def _add_slot(self, assignment, proposed):
+        slot = assignment.slot
+        self.slots[slot.start.isoformat()] = {
+            "end": slot.end.isoformat(),
+            "costs": assignment.costs,
+            "proposed": [person.email for person in proposed],
+        }
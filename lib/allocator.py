@@ -15,10 +15,21 @@ Takes into account:
 """
 
 from collections import Counter
+from conflict_matrix import ConflictMatrix, UNAVAILABLE
+from interviewers import (
+    BAME, CHAIR, CIVIL_SERVANT, FRONTEND, MAN, NON_BAME, TECHNICAL, WOMAN,
+    attribute_bits,
+)
 from datetime import timedelta
+import bisect
+import heapq
 import math
+import numpy
 # from pprint import pprint
 
+# People can't be assigned to two slots which start closer together than this.
+min_gap_between_slots = timedelta(hours=23)
+
 
 class SlotAssignment(object):
     def __init__(self, slot, interviewers):
@@ -29,7 +40,16 @@ class SlotAssignment(object):
         """
         self.slot = slot
         self._interviewers = interviewers
-        self._assigned = self._already_assigned(slot.event, interviewers)
+        self._assigned = []
+        # Running counts of the people assigned with each attribute bit, and
+        # with each gender and BAME status.
+        self._counts = dict((bit, 0) for bit in attribute_bits)
+        self._genders = Counter()
+        self._bames = Counter()
+        # Whether the people assigned are counted in their planned work.
+        self.counted = False
+        for person in self._already_assigned(slot.event, interviewers):
+            self._add_person(person)
         self._possible_emails = {}
         self.costs = {}
 
@@ -54,15 +74,69 @@ class SlotAssignment(object):
         return self._possible_emails.get(level, [])
 
     def assign(self, email):
-        assert email in reduce(lambda x, y: x + y, self._possible_emails.values(), [])
+        assert any(
+            email in emails for emails in self._possible_emails.values())
         try:
             interviewer = self._interviewers.by_email(email)
         except KeyError:
             print "Unknown email to assign to interview"
         else:
-            self._assigned.append(interviewer)
+            self._add_person(interviewer)
         self.remove_from_possible(email)
 
+    def unassign(self, email):
+        """Remove someone from the slot, making them possible again."""
+        for person in self._assigned:
+            if person.email == email:
+                self._remove_person(person)
+                break
+        else:
+            raise ValueError("{} not assigned to slot".format(email))
+        if email in self.costs:
+            self.add_to_possible(self.costs[email], email)
+
+    def set_counted(self, counted):
+        """Set whether the people assigned to the slot are counted in their
+        planned work.
+
+        While counted, people's planned work and slots in each week are kept
+        up to date as they are assigned and unassigned.
+
+        """
+        if counted != self.counted:
+            for person in self._assigned:
+                self._count(person, 1 if counted else -1)
+            self.counted = counted
+
+    def _count(self, person, change):
+        person.newly_assigned_interviews += change
+        person.new_slots_by_isoweek[self.slot.isoweek] += change
+
+    def _add_person(self, person):
+        self._assigned.append(person)
+        for bit in attribute_bits:
+            if person.attributes & bit:
+                self._counts[bit] += 1
+        self._genders[person.gender] += 1
+        self._bames[person.bame] += 1
+        if self.counted:
+            self._count(person, 1)
+
+    def _remove_person(self, person):
+        self._assigned.remove(person)
+        if self.counted:
+            self._count(person, -1)
+        for bit in attribute_bits:
+            if person.attributes & bit:
+                self._counts[bit] -= 1
+        for counter, value in (
+            (self._genders, person.gender),
+            (self._bames, person.bame),
+        ):
+            counter[value] -= 1
+            if counter[value] == 0:
+                del counter[value]
+
     def add_to_possible(self, conflict_level, email):
         self.remove_from_possible(email)
         self._possible_emails.setdefault(conflict_level, []).append(email)
@@ -97,70 +171,52 @@ class SlotAssignment(object):
         """
         return (
             len(self._assigned) == 3 and
-            self.has_chair and
-            self.has_two_tech and
-            self.gender_diverse and
-            self.bame_diverse and
-            self.has_two_civil_servants
+            self._counts[CHAIR] > 0 and
+            self._counts[TECHNICAL] >= 2 and
+            len(self._genders) >= 2 and
+            len(self._bames) >= 2 and
+            self._counts[CIVIL_SERVANT] >= 2
         )
 
     @property
     def has_chair(self):
-        return any(person.can_chair for person in self._assigned)
+        return self._counts[CHAIR] > 0
 
     @property
     def can_be_frontend(self):
-        return any(person.can_do_frontend_test for person in self._assigned)
+        return self._counts[FRONTEND] > 0
 
     @property
     def has_two_tech(self):
-        return len(filter(lambda person: person.technical, self._assigned)) >= 2
+        return self._counts[TECHNICAL] >= 2
 
     @property
     def has_two_civil_servants(self):
-        return len(filter(lambda person: person.civil_servant, self._assigned)) >= 2
+        return self._counts[CIVIL_SERVANT] >= 2
 
     @property
     def gender_diverse(self):
-        genders = Counter()
-        for person in self._assigned:
-            genders[person.gender] += 1
-        return len(genders) >= 2
+        return len(self._genders) >= 2
 
     @property
     def has_women(self):
-        genders = Counter()
-        for person in self._assigned:
-            genders[person.gender] += 1
-        return genders['f'] > 0
+        return self._counts[WOMAN] > 0
 
     @property
     def has_man(self):
-        genders = Counter()
-        for person in self._assigned:
-            genders[person.gender] += 1
-        return genders['m'] > 0
+        return self._counts[MAN] > 0
 
     @property
     def bame_diverse(self):
-        bames = Counter()
-        for person in self._assigned:
-            bames[person.bame] += 1
-        return len(bames) >= 2
+        return len(self._bames) >= 2
 
     @property
     def has_bame(self):
-        bames = Counter()
-        for person in self._assigned:
-            bames[person.bame] += 1
-        return bames['y'] > 0
+        return self._counts[BAME] > 0
 
     @property
     def has_non_bame(self):
-        bames = Counter()
-        for person in self._assigned:
-            bames[person.bame] += 1
-        return bames['n'] > 0
+        return self._counts[NON_BAME] > 0
 
     @property
     def cost(self):
@@ -182,10 +238,18 @@ class SlotAssignments(object):
             (assignment.slot.start, assignment)
             for assignment in assignments
         )
+        # Start times of all the slots, and of the new slots, in order.
+        self._order = sorted(self.assignments)
+        self._new_order = [
+            start for start in self._order
+            if self.assignments[start].slot.new
+        ]
+        for start in self._new_order:
+            self.assignments[start].set_counted(True)
 
     def __iter__(self):
-        for _, assignment in sorted(self.assignments.items()):
-            yield assignment
+        for start in self._order:
+            yield self.assignments[start]
 
     def __len__(self):
         return len(self.assignments)
@@ -193,27 +257,80 @@ class SlotAssignments(object):
     def assign(self, slot_start, email):
         self.assignments[slot_start].assign(email)
 
+    def add(self, assignment):
+        start = assignment.slot.start
+        if start not in self.assignments:
+            bisect.insort(self._order, start)
+            if assignment.slot.new:
+                bisect.insort(self._new_order, start)
+        self.assignments[start] = assignment
+        if assignment.slot.new:
+            assignment.set_counted(True)
+
     def drop(self, assignment):
         assignment.slot.event.attendees = {}
-        del self.assignments[assignment.slot.start]
+        assignment.set_counted(False)
+        start = assignment.slot.start
+        del self.assignments[start]
+        self._order.remove(start)
+        if assignment.slot.new:
+            self._new_order.remove(start)
 
     def new_assignments(self):
-        return self.new_where(lambda assignment: assignment.slot.new)
+        return SlotAssignmentsView(self, ())
 
     def new_where(self, check):
-        return SlotAssignments(
-            assignment
-            for (_, assignment) in sorted(self.assignments.items())
-            if assignment.slot.new and check(assignment)
-        )
+        return SlotAssignmentsView(self, (check,))
+
+
+class SlotAssignmentsView(object):
+    """The new slot assignments which pass some checks.
+
+    The checks are applied while iterating, so the view reflects any changes
+    made since it was created.  Copy it to a list before dropping any of the
+    assignments in it.
+
+    """
+    def __init__(self, slot_assignments, checks):
+        self.slot_assignments = slot_assignments
+        self.checks = checks
+
+    def __iter__(self):
+        assignments = self.slot_assignments.assignments
+        for start in self.slot_assignments._new_order:
+            assignment = assignments[start]
+            if all(check(assignment) for check in self.checks):
+                yield assignment
+
+    def __len__(self):
+        if not self.checks:
+            return len(self.slot_assignments._new_order)
+        return sum(1 for _ in self)
+
+    def assign(self, slot_start, email):
+        self.slot_assignments.assign(slot_start, email)
+
+    def new_assignments(self):
+        return self
+
+    def new_where(self, check):
+        return SlotAssignmentsView(
+            self.slot_assignments, self.checks + (check,))
 
 
 class PossibleAssignments(object):
     def __init__(self, assignments):
+        # The emails of the people who could be assigned to each slot.
         self.slots = dict(
-            (assignment.slot.start, [])
+            (assignment.slot.start, set())
             for assignment in assignments
         )
+        # The slots each person could be assigned to.
+        self.slots_for_person = {}
+        # The slots starting on each day, for finding nearby slots.
+        self.slots_by_day = {}
+        for start in self.slots:
+            self.slots_by_day.setdefault(start.date(), set()).add(start)
         self.options_for_person = Counter()
 
     def assignments_possible(self):
@@ -224,28 +341,47 @@ class PossibleAssignments(object):
         )
 
     def add(self, start, email):
-        if start in self.slots:
-            self.slots[start].append(email)
+        emails = self.slots.get(start)
+        if emails is not None and email not in emails:
+            emails.add(email)
+            self.slots_for_person.setdefault(email, set()).add(start)
             self.options_for_person[email] += 1
 
     def people_busiest_first(self):
-        return map(
-            lambda x: x[0],
-            sorted(
-                self.options_for_person.items(),
-                key = lambda x: (x[1], x[0])
-            )
-        )
+        """Iterate through the people, with the fewest options first.
+
+        The order takes account of any assignments made while iterating, so
+        each person is returned when they have the fewest options of those
+        remaining.
+
+        """
+        heap = [
+            (count, email)
+            for email, count in self.options_for_person.items()
+        ]
+        heapq.heapify(heap)
+        while heap:
+            count, email = heapq.heappop(heap)
+            current = self.options_for_person[email]
+            if count != current:
+                heapq.heappush(heap, (current, email))
+                continue
+            yield email
 
     def busiest_slot_possible(self, email):
-        busyness = {}
-        for start, emails in self.slots.items():
-            if email in emails:
-                busyness[start] = len(emails)
-        slots = sorted(busyness.items(), key = lambda x: x[1])
-        if len(slots) > 0:
-            return slots[0][0]
-        return None
+        slots = self.slots_for_person.get(email)
+        if not slots:
+            return None
+        return min(slots, key=lambda start: (len(self.slots[start]), start))
+
+    def nearby_slots(self, start):
+        """Return the slots starting within 23 hours of a time."""
+        day = start.date()
+        for offset in (-1, 0, 1):
+            for slot_start in self.slots_by_day.get(
+                    day + timedelta(days=offset), ()):
+                if abs(start - slot_start) < min_gap_between_slots:
+                    yield slot_start
 
     def assigned(self, start, email):
         """Record that someone is assigned to a slot at a time.
@@ -254,14 +390,14 @@ class PossibleAssignments(object):
         nearby slots.
 
         """
-
-        for slot_start, emails in self.slots.items():
-            if abs(start - slot_start) < timedelta(hours=23):
-                try:
-                    emails.remove(email)
-                    self.options_for_person[email] -= 1
-                except ValueError:
-                    pass
+        slots = self.slots_for_person.get(email)
+        if not slots:
+            return
+        for slot_start in list(self.nearby_slots(start)):
+            if slot_start in slots:
+                slots.remove(slot_start)
+                self.slots[slot_start].remove(email)
+                self.options_for_person[email] -= 1
 
     def drop_slot(self, start):
         """Drop a slot from the list of possible slots.
@@ -270,13 +406,14 @@ class PossibleAssignments(object):
 
         """
         if start in self.slots:
-            for old_email in self.slots[start]:
+            for old_email in self.slots.pop(start):
+                self.slots_for_person[old_email].remove(start)
                 self.options_for_person[old_email] -= 1
-            del self.slots[start]
+            self.slots_by_day[start.date()].remove(start)
 
 
 class Allocator(object):
-    def __init__(self, slots, interviewers, assignments):
+    def __init__(self, slots, interviewers, assignments, state=None):
         # All our interviewers
         self.interviewers = interviewers
 
@@ -287,12 +424,20 @@ class Allocator(object):
         # Who is assigned to each slot
         self.assignments = assignments
 
+        # Slots which were dropped because they couldn't be filled
+        self.dropped = []
+
+        # The AllocationState from the previous run, if any
+        self.state = state
+
     def allocate(self):
         self.count_recent_interviews()
         self.conflict_levels = self.calc_conflict_levels(
             self.interviewers,
-            self.assignments
+            self.assignments,
+            self.state,
         )
+        self.warm_start()
 
         self.allocate_chairs()
         self.allocate_frontend()
@@ -306,23 +451,18 @@ class Allocator(object):
         self.update_assignment_events()
 
     def update_assignment_events(self):
-        for interviewer in self.interviewers:
-            # print interviewer.email, interviewer.newly_assigned_interviews
-            interviewer.newly_assigned_interviews = 0
-            interviewer.new_slots_by_isoweek.clear()
+        """Set the attendees of the events for the new slots.
 
+        People's planned work is kept up to date by the assignments as they
+        change, so only needs the events to be written once allocation is
+        finished.
+
+        """
         for assignment in self.assignments.new_assignments():
             assignment.slot.event.attendees = {"needsAction": [
                 email
                 for email in assignment.assigned
             ]}
-            for interviewer in assignment.assigned:
-                interviewer.newly_assigned_interviews += 1
-                interviewer.new_slots_by_isoweek[assignment.slot.isoweek] += 1
-
-        # print
-        # for interviewer in self.interviewers:
-        #    print interviewer.email, interviewer.newly_assigned_interviews
 
     def allocate_chairs(self):
         """Allocate chairs to slots
@@ -461,12 +601,13 @@ class Allocator(object):
         """Drop any slots which match the check
         
         """
-        for assignment in self.assignments.new_where(check):
+        for assignment in list(self.assignments.new_where(check)):
             print "Unable to allocate {} to interview at {}".format(
                 description,
                 assignment.slot.start
             )
             self.assignments.drop(assignment)
+            self.dropped.append(assignment)
 
     def assign_people(self, check, people, rate_to_fill=1.0, max_conflict_level=1000000000):
         assignments_made = set()
@@ -494,7 +635,6 @@ class Allocator(object):
                 continue
             if sum(work_share.values()) <= 0:
                 break
-            self.update_assignment_events()
 
             # print "At conflict level {}".format(conflict_level)
             possible_at_level = PossibleAssignments(assignments_to_fill.new_where(
@@ -512,7 +652,7 @@ class Allocator(object):
             # possible
             for assignment in self.assignments:
                 for person in assignment.assigned:
-                    if person.email in people_by_email.keys():
+                    if person.email in people_by_email:
                         # print "Already: {} {}".format(assignment.slot.start, person.email)
                         possible_at_level.assigned(
                             assignment.slot.start,
@@ -534,7 +674,7 @@ class Allocator(object):
                         if slot_start is not None:
                             teams = Counter(
                                 person.team
-                                for person in assignments_to_fill.assignments[slot_start].assigned
+                                for person in self.assignments.assignments[slot_start].assigned
                             )
                             person = people_by_email[email]
                             if teams.get(person.team) >= 1:
@@ -558,7 +698,6 @@ class Allocator(object):
                             possible_at_level.drop_slot(slot_start)
                             assignments_to_fill.assign(slot_start, email)
                             work_share[email] -= 1
-                            person.new_slots_by_isoweek[isoweek] += 1
                             changed = True
                             assignments_made.add(slot_start)
                             number_to_fill -= 1
@@ -644,22 +783,89 @@ class Allocator(object):
 
 
     @staticmethod
-    def calc_conflict_levels(interviewers, assignments):
+    def calc_conflict_levels(interviewers, assignments, state=None):
+        """Calculate the conflict level of each person for each new slot.
+
+        If an AllocationState is given, levels are reused from it where the
+        slot and the person's calendar haven't changed.
+
+        """
+        interviewers = list(interviewers)
+        interviewers_by_email = dict(
+            (person.email, person) for person in interviewers)
+        new_assignments = list(assignments.new_assignments())
+        slots = [assignment.slot for assignment in new_assignments]
+        if state is not None:
+            slot_costs = state.conflict_levels(interviewers, slots)
+        else:
+            matrix = ConflictMatrix(interviewers, slots)
+            slot_costs = []
+            for column in range(len(slots)):
+                levels = matrix.levels[:, column]
+                slot_costs.append(dict(
+                    (interviewers[row].email, int(levels[row]))
+                    for row in numpy.flatnonzero(levels != UNAVAILABLE)
+                ))
+
         conflict_levels = set()
-        for assignment in assignments.new_assignments():
-            costs = {}
-            for interviewer in interviewers:
-                conflict_level = interviewer.calendar.conflict_level(
-                    assignment.slot.start, assignment.slot.end)
-                if conflict_level is None:
-                    continue
+        for assignment, costs in zip(new_assignments, slot_costs):
+            for email, conflict_level in sorted(costs.items()):
                 conflict_levels.add(conflict_level)
-                assignment.add_to_possible(conflict_level, interviewer.email)
-                interviewer.add_to_possible(conflict_level, assignment.slot.start)
-                costs[interviewer.email] = conflict_level
+                assignment.add_to_possible(conflict_level, email)
+                interviewers_by_email[email].add_to_possible(
+                    conflict_level, assignment.slot.start)
             assignment.costs = costs
         return sorted(conflict_levels)
 
+    def warm_start(self):
+        """Assign the panels proposed for new slots in the previous run, where
+        they are still possible and viable.
+
+        """
+        if self.state is None:
+            return
+        busy_times = {}
+        for assignment in self.assignments:
+            for person in assignment.assigned:
+                busy_times.setdefault(person.email, []).append(
+                    assignment.slot.start)
+
+        kept = 0
+        for assignment in self.assignments.new_assignments():
+            proposed = self.state.proposed(assignment.slot)
+            if not proposed or assignment.assigned:
+                continue
+            try:
+                people = [self.interviewers.by_email(email) for email in proposed]
+            except KeyError:
+                continue
+            start = assignment.slot.start
+            if not (
+                len(set(person.team for person in people)) == len(people) and
+                all(
+                    person.email in assignment.costs and
+                    person.slots_in_week(assignment.slot.isoweek) <
+                    person.use_freq and
+                    not any(
+                        abs(start - busy) < min_gap_between_slots
+                        for busy in busy_times.get(person.email, ())
+                    )
+                    for person in people
+                )
+            ):
+                continue
+            for person in people:
+                assignment.assign(person.email)
+            if not assignment.viable:
+                for person in people:
+                    assignment.unassign(person.email)
+                continue
+            for person in people:
+                busy_times.setdefault(person.email, []).append(start)
+            kept += 1
+        print
+        print "Kept {} panels from the previous allocation".format(kept)
+
     def display_interviewer_stats(self):
         headings = [
             "Chair",
@@ -1,14 +1,25 @@
 import datetime
 import json
 import os
-import requests
 import time
 
 
+bank_holidays_path = "/bank-holidays/england-and-wales.json"
+bank_holidays_url = "https://www.gov.uk" + bank_holidays_path
+
+
+def download(url):
+    # requests is slow to import, and usually isn't needed.
+    import requests
+    return requests.get(url).content
+
+
 class BankHolidays(object):
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, snapshot=None, url=bank_holidays_url):
         self._dates = []
         self.cache_dir = cache_dir
+        self.snapshot = snapshot
+        self.url = url
 
     def dates(self):
         data = self._fetch()
@@ -28,13 +39,18 @@ class BankHolidays(object):
             os.makedirs(self.cache_dir)
         holidays_file = os.path.join(self.cache_dir, "holidays")
 
+        if self.snapshot is not None:
+            return json.loads(self.snapshot.get(
+                self.url,
+                download,
+            ))
         if (
             os.path.isfile(holidays_file + ".json") and
             time.time() - os.stat(holidays_file + ".json").st_mtime < 86400
         ):
             with open(holidays_file + ".json") as fobj:
                 return json.load(fobj)
-        data = requests.get("https://www.gov.uk/bank-holidays/england-and-wales.json").content
+        data = download(self.url)
         with open(holidays_file + ".json", "wb") as fobj:
             fobj.write(data)
         return json.loads(data)
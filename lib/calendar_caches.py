@@ -0,0 +1,14 @@
+"""The formats which calendars can be cached in."""
+
+from collections import OrderedDict
+
+from calendar_fetcher import CalendarCache
+from columnar_cache import ColumnarCalendarCache
+from event_store import SqliteCalendarCache
+
+# Classes of CalendarCache, by the name of the format they use.
+cache_formats = OrderedDict([
+    ("json", CalendarCache),
+    ("columnar", ColumnarCalendarCache),
+    ("sqlite", SqliteCalendarCache),
+])
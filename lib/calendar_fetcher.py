@@ -1,11 +1,24 @@
-from apiclient import discovery
+from collections import OrderedDict
+import bisect
 import datetime
 import dateutil.parser
-import httplib2
+import hashlib
 import json
 import os
 import pytz
+import Queue
 import re
+import sys
+import threading
+import time
+
+from rate_limit import (
+    RequestExecutor,
+    TokenBucket,
+    Unlimited,
+)
+from snapshot import ReplayHttp
+from traffic import TrafficCounter
 
 # Events which should block being invited, even if the event isn't marked as
 # busy time (eg, people mark themselves as "out of the office" with an event,
@@ -22,10 +35,120 @@ unavailable_events = re.compile(r'\b((leave)|(al)|(a/l)|(holiday)|(off)|(validat
 
 preferred_events = re.compile(r'preferred interview slot')
 
+# Default limit on the rate of requests to the calendar API, shared between
+# all the connections made by a CalendarService and its copies.  The API's
+# default per-user quota is 500 requests per 100 seconds.
+default_requests_per_second = 5
+
+# Number of results to ask for in each page: the most the API allows.
+events_per_page = 2500
+calendars_per_page = 250
+
+# The parts of events and calendars which are used.  Only these are asked
+# for, so that google doesn't send the rest.
+event_fields = (
+    "id,status,start,end,summary,transparency,"
+    "attendees(email,responseStatus,optional,resource,self)"
+)
+events_list_fields = "etag,items({}),nextPageToken,nextSyncToken".format(
+    event_fields)
+calendar_list_fields = "etag,items(id,summary),nextPageToken"
+
+# Google only compresses responses for clients which mention gzip in their
+# user agent, as well as accepting it.  The client library does this for API
+# calls, but not for other requests, such as for the discovery document.
+user_agent = "interview-rota (gzip)"
+
+# Where the calendar API's discovery document is fetched from, below the
+# google API server (or the server given as a CalendarService's base_url).
+google_api_url = "https://www.googleapis.com"
+discovery_path = "/discovery/v1/apis/calendar/v3/rest"
+
+# Seconds a saved discovery document is used for before fetching it again.
+discovery_max_age = 7 * 86400
+
+# How far beyond the end of the window to fetch events for, so that later runs
+# can sync changes to the calendar rather than fetching it all again.
+sync_lookahead = datetime.timedelta(days=28)
+
+# Classification flags for events, computed once when an event is parsed.
+PREFERRED = 1
+OTHER_COMMITMENT = 2
+UNAVAILABLE = 4
+BUSY_ACCEPTED = 8
+
+# Events with any of these flags make the time unavailable.
+BLOCKING = OTHER_COMMITMENT | UNAVAILABLE
+
+# Conflict levels for the number of accepted attendees of the busiest
+# overlapping event: none, one, two, three or more.
+ATTENDEE_CONFLICT_LEVELS = (1, 2, 5, 10)
+
+# The RFC3339 times and dates returned by the calendar API.  Anything else is
+# left to dateutil.
+iso_datetime_re = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(Z|[+-]\d\d:\d\d))?$'
+)
+
+# UTC offsets seen so far, by their string form.  Calendars only use a few.
+utc_offsets = {"Z": datetime.timedelta(0)}
+
+
+def utc_offset(offset):
+    """Return the timedelta for a UTC offset of the form "+01:00"."""
+    result = utc_offsets.get(offset)
+    if result is None:
+        result = datetime.timedelta(
+            hours=int(offset[1:3]), minutes=int(offset[4:6]))
+        if offset[0] == "-":
+            result = -result
+        utc_offsets[offset] = result
+    return result
+
+
+class EventClassifier(object):
+    """Classify events by their summary and status.
+
+    Subclass this, or construct it with different patterns, to change which
+    events affect the conflict level of a slot.
+
+    """
+    def __init__(self,
+                 preferred=preferred_events,
+                 other_commitment=other_commitment_events,
+                 unavailable=unavailable_events):
+        self.preferred = preferred
+        self.other_commitment = other_commitment
+        self.unavailable = unavailable
+
+    def classify(self, event):
+        """Return the classification flags for an event.
+
+        A preferred event gets no other flags: it marks the time as preferred
+        whatever else it says.
+
+        """
+        summary = event.summary.lower()
+        if self.preferred.search(summary):
+            return PREFERRED
+        flags = 0
+        if self.other_commitment.search(summary):
+            flags |= OTHER_COMMITMENT
+        if self.unavailable.search(summary):
+            flags |= UNAVAILABLE
+        if event.busy and event.response_status == "accepted":
+            flags |= BUSY_ACCEPTED
+        return flags
+
 
 class Event(object):
-    def __init__(self, data, is_saved, calendar_id=None):
+    # The classifier used for events which aren't given one explicitly.
+    classifier = EventClassifier()
+
+    def __init__(self, data, is_saved, calendar_id=None, classifier=None):
         self.is_saved = is_saved
+        self.id = data.get("id")
         self.start = self.parse_date_or_time(data["start"], is_start=True)
         self.end = self.parse_date_or_time(data["end"], is_start=False)
         self.summary = data.get("summary", "")
@@ -39,6 +162,10 @@ class Event(object):
         else:
             self.response_status = invitation.get("responseStatus", "")
             self.optional = invitation.get("optional", False)
+        self.accepted_count = len(self.attendees.get("accepted", []))
+        if classifier is None:
+            classifier = self.classifier
+        self.flags = classifier.classify(self)
 
     def intersects_with(self, start, end):
         if end <= self.start:
@@ -72,17 +199,33 @@ class Event(object):
 
     @staticmethod
     def parse_iso_datetime(iso_date_string, is_start):
-        if is_start:
-            default = datetime.datetime(
-                year=2000, month=1, day=1,
-                hour=0, minute=0, tzinfo=pytz.utc,
-            )
-        else:
-            default = datetime.datetime(
-                year=2000, month=1, day=1,
-                hour=0, minute=0, tzinfo=pytz.utc,
-            )
+        """Parse a date or time from the calendar API, returning a datetime
+        in UTC.  Dates are taken as midnight UTC.
 
+        """
+        match = iso_datetime_re.match(iso_date_string)
+        if match is None:
+            return Event._parse_with_dateutil(iso_date_string)
+        (year, month, day, hour, minute, second, fraction,
+         offset) = match.groups()
+        if hour is None:
+            return datetime.datetime(
+                int(year), int(month), int(day), tzinfo=pytz.utc)
+        result = datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour), int(minute), int(second),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+        )
+        if offset != "Z":
+            result -= utc_offset(offset)
+        return result.replace(tzinfo=pytz.utc)
+
+    @staticmethod
+    def _parse_with_dateutil(iso_date_string):
+        default = datetime.datetime(
+            year=2000, month=1, day=1,
+            hour=0, minute=0, tzinfo=pytz.utc,
+        )
         return pytz.utc.normalize(
             dateutil.parser.parse(
                 iso_date_string, default=default
@@ -107,7 +250,7 @@ class Event(object):
         return result
 
     def is_unavailable_event(self):
-        if unavailable_events.search(self.summary.lower()):
+        if self.flags & UNAVAILABLE:
             return True
 
     def __repr__(self):
@@ -122,16 +265,61 @@ class Event(object):
         ).encode('utf8')
 
 
+def event_in_range(data, start, end):
+    """Return True if the raw event data overlaps the time from start to end.
+
+    """
+    return (
+        Event.parse_date_or_time(data["start"], is_start=True) < end and
+        Event.parse_date_or_time(data["end"], is_start=False) > start
+    )
+
+
+def events_fingerprint(data):
+    """Return a fingerprint of the raw data for a list of events."""
+    return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+
 class Calendar(object):
-    def __init__(self, calendar_summary, events):
+    def __init__(self, calendar_summary, events, fingerprint=None):
+        """A calendar.
+
+        :param fingerprint: A string which changes whenever the events in the
+        calendar change, other than by events moving out of the start of
+        the window, or None if not known.
+
+        """
         self.calendar_summary = calendar_summary
         self.events = sorted(events, key=lambda e: e.start)
+        self.fingerprint = fingerprint
+
+        # Index for overlap queries: the start times of the events (in the
+        # same order as self.events), and the running maximum of their end
+        # times.  The running maximum never decreases, so both can be
+        # searched with bisect.
+        self._starts = [event.start for event in self.events]
+        self._max_ends = []
+        max_end = None
+        for event in self.events:
+            if max_end is None or event.end > max_end:
+                max_end = event.end
+            self._max_ends.append(max_end)
 
     def intersecting_events(self, start, end):
+        """Return the events which overlap the time from start to end.
+
+        Events are returned in order of start time.
+
+        """
+        # Events from index `hi` onwards start at or after `end`, and no event
+        # before index `lo` ends after `start`, so only the events in between
+        # need to be checked.
+        hi = bisect.bisect_left(self._starts, end)
+        lo = bisect.bisect_right(self._max_ends, start, 0, hi)
         return [
             event
-            for event in self.events
-            if event.intersects_with(start, end)
+            for event in self.events[lo:hi]
+            if event.end > start
         ]
 
     def conflict_level(self, start, end):
@@ -148,62 +336,236 @@ class Calendar(object):
         max_attendees = 0
         is_preferred = False
         for event in events:
-            if preferred_events.search(event.summary.lower()):
+            flags = event.flags
+            if flags & PREFERRED:
                 is_preferred = True
-                continue
-            if other_commitment_events.search(event.summary.lower()):
+            elif flags & BLOCKING:
                 return None
-            if event.is_unavailable_event():
-                return None
-            if event.busy:
-                if event.response_status != "accepted":
-                    continue
-                max_attendees = max(max_attendees,
-                    len(event.attendees.get("accepted", [])))
+            elif flags & BUSY_ACCEPTED:
+                if event.accepted_count > max_attendees:
+                    max_attendees = event.accepted_count
         if is_preferred:
             return 0
-        elif max_attendees == 0:
-            return 1
-        elif max_attendees == 1:
-            return 2
-        elif max_attendees == 2:
-            return 5
-        else:
-            return 10
+        return ATTENDEE_CONFLICT_LEVELS[min(max_attendees, 3)]
 
 
 class CalendarService(object):
-    def __init__(self, creds):
+    def __init__(self, creds, rate_limiter=None, snapshot=None,
+                 base_url=None, traffic=None, cache_dir=None):
+        """Access to the google calendar API.
+
+        Nothing is fetched from google, and the client library isn't
+        imported, until a request needs to be made.
+
+        :param creds: The oauth2client credentials to use.  May be None when
+        using base_url.
+        :param rate_limiter: Limit on the rate of requests.
+        :param snapshot: A Snapshot to record the responses in, or to replay
+        responses from instead of contacting google.
+        :param base_url: The URL of a server to use instead of google, such
+        as a FakeCalendarServer.
+        :param traffic: A TrafficCounter to count requests in.
+        :param cache_dir: A directory to keep the API's discovery document
+        in, so that it doesn't need fetching on every run.  It isn't used
+        with a snapshot, so that snapshots hold everything needed to replay
+        them.
+
+        """
         self.creds = creds
+        self.snapshot = snapshot
+        self.base_url = base_url
+        self.cache_dir = cache_dir
         self._service = None
-        self._calendars = None
+        # The list of calendars and the discovery document, which are fetched
+        # when first needed, and shared with copies.
+        self._shared = {}
+        self._shared_lock = threading.RLock()
+        if rate_limiter is None:
+            if snapshot is not None and snapshot.replaying:
+                rate_limiter = Unlimited()
+            else:
+                rate_limiter = TokenBucket(default_requests_per_second)
+        self.rate_limiter = rate_limiter
+        self.traffic = traffic if traffic is not None else TrafficCounter()
+        self.executor = RequestExecutor(rate_limiter, self.traffic)
+
+    def copy(self):
+        """Return a CalendarService with its own connection to google.
+
+        The http objects used to talk to google aren't thread safe, so each
+        thread needs its own CalendarService.  Copies share the rate limiter,
+        the request executor (and so its concurrency limit), the traffic
+        counter, the list of calendars and the discovery document.
+
+        """
+        service = CalendarService(
+            self.creds, self.rate_limiter, self.snapshot, self.base_url,
+            self.traffic, self.cache_dir)
+        service.executor = self.executor
+        service._shared = self._shared
+        service._shared_lock = self._shared_lock
+        return service
+
+    def execute(self, request, cost=1):
+        """Execute an API request, once the rate and concurrency limits
+        allow it, retrying it if it fails with an error which may be
+        temporary.
+
+        `cost` is the number of requests to count against the rate limit, for
+        batch requests.
+
+        """
+        return self.executor.execute(request, cost)
+
+    def new_batch(self, callback):
+        """Return a new batch request for the calendar API.
+
+        `callback` is called with the request id, response and exception (or
+        None) of each request in the batch.
+
+        """
+        return self.service().new_batch_http_request(callback=callback)
 
     def service(self):
         if self._service is None:
-            http = self.creds.authorize(httplib2.Http())
-            self._service = discovery.build('calendar', 'v3', http=http)
+            from apiclient import discovery
+            self._service = discovery.build_from_document(
+                self._discovery_document(), http=self._http())
         return self._service
 
+    def _discovery_document(self):
+        with self._shared_lock:
+            if "discovery" not in self._shared:
+                self._shared["discovery"] = self._load_discovery_document()
+            return self._shared["discovery"]
+
+    def _load_discovery_document(self):
+        """Return the discovery document from the cache directory, or
+        fetch it if it isn't there or is out of date.
+
+        """
+        saved = self._load_saved("discovery.json", discovery_max_age)
+        if saved is not None:
+            return saved["document"]
+
+        from apiclient.errors import HttpError
+        url = self._api_url() + discovery_path
+        resp, content = self._http().request(url)
+        if resp.status >= 400:
+            raise HttpError(resp, content, uri=url)
+        self._save("discovery.json", {"document": content})
+        return content
+
+    def _api_url(self):
+        return self.base_url or google_api_url
+
+    def _load_saved(self, filename, max_age=None):
+        """Return what was saved in a file in the cache directory for the
+        API server being used, or None.
+
+        :param max_age: Seconds after which the file is ignored.
+
+        """
+        if self.cache_dir is None or self.snapshot is not None:
+            return None
+        path = os.path.join(self.cache_dir, filename)
+        if not os.path.isfile(path):
+            return None
+        if (
+            max_age is not None and
+            time.time() - os.stat(path).st_mtime >= max_age
+        ):
+            return None
+        with open(path, "rb") as fobj:
+            saved = json.load(fobj)
+        if saved["url"] != self._api_url():
+            return None
+        return saved
+
+    def _save(self, filename, saved):
+        """Save a dict in a file in the cache directory, unless recording or
+        replaying a snapshot.
+
+        """
+        if self.cache_dir is None or self.snapshot is not None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = os.path.join(self.cache_dir, filename)
+        with open(path + ".tmp", "wb") as fobj:
+            json.dump(dict(saved, url=self._api_url()), fobj)
+        os.rename(path + ".tmp", path)
+
+    def _http(self):
+        if self.snapshot is not None and self.snapshot.replaying:
+            return ReplayHttp(self.snapshot)
+        from apiclient.http import set_user_agent
+        import httplib2
+        http = set_user_agent(
+            self.traffic.wrap_http(httplib2.Http()), user_agent)
+        if self.creds is not None:
+            http = self.creds.authorize(http)
+        if self.snapshot is not None:
+            http = self.snapshot.wrap_http(http)
+        return http
+
     def calendar_id(self, calendar_summary):
-        if self._calendars is None:
-            self._fetch_list_of_calendars()
-        return self._calendars.get(calendar_summary, calendar_summary)
+        with self._shared_lock:
+            if "calendars" not in self._shared:
+                self._shared["calendars"] = self._load_calendars()
+            calendars = self._shared["calendars"]
+        return calendars.get(calendar_summary, calendar_summary)
 
     def events(self):
         return self.service().events()
 
-    def _fetch_list_of_calendars(self):
-        self._calendars = dict(self._iter_calendars())
+    def _load_calendars(self):
+        """Return a dict from calendar summary to calendar id.
 
-    def _iter_calendars(self):
+        The list of calendars is saved in the cache directory with its
+        ETag, and only fetched again if google says it has changed.
+
+        """
+        from apiclient.errors import HttpError
+        saved = self._load_saved("calendar_list.json")
+        calendars = {}
+        etag = None
         page_token = None
         while True:
-            results = self.service().calendarList().list(pageToken=page_token).execute()
+            request = self.service().calendarList().list(
+                pageToken=page_token,
+                maxResults=calendars_per_page,
+                fields=calendar_list_fields,
+            )
+            if page_token is None and saved is not None:
+                request.headers["If-None-Match"] = saved["etag"]
+            try:
+                results = self.execute(request)
+            except HttpError as e:
+                if e.resp.status == 304:
+                    return saved["calendars"]
+                raise
+            if page_token is None:
+                etag = results.get('etag')
             for result in results['items']:
-                yield (result['summary'], result['id'])
+                calendars[result['summary']] = result['id']
             page_token = results.get('nextPageToken')
             if page_token is None:
                 break
+        if etag is not None:
+            self._save("calendar_list.json", {
+                "etag": etag,
+                "calendars": calendars,
+            })
+        return calendars
+
+
+class SyncTokenExpired(Exception):
+    """The sync token for a calendar is no longer valid.
+
+    All the events in the calendar need to be fetched again.
+
+    """
 
 
 class CalendarFetcher(object):
@@ -211,73 +573,349 @@ class CalendarFetcher(object):
         self.service = service
         self.date_min_formatted = date_min_formatted
         self.date_max_formatted = date_max_formatted
-        
+
     def fetch_events(self, calendar_summary):
+        """Fetch all the events in the date range.
+
+        Returns a tuple of the list of events, a sync token which can be used
+        to fetch changes to them later (or None if google didn't supply one),
+        and the ETag of the calendar's events (or None).
+
+        """
         print("Fetching calendar for %s" % (calendar_summary, ))
-        return list(self._iter_events(self.service.calendar_id(calendar_summary)))
+        return self._list_events(
+            self.service.calendar_id(calendar_summary),
+            timeMin=self.date_min_formatted,
+            timeMax=self.date_max_formatted,
+        )
 
-    def _iter_events(self, calendar_id):
-        page_token = None
+    def fetch_changes(self, calendar_summary, sync_token, etag=None):
+        """Fetch the events which have changed since a sync token was issued.
+
+        Deleted events are included, with a status of "cancelled".
+
+        :param etag: The ETag of the calendar's events when the sync token
+        was issued.  If given, and the events haven't changed since, google
+        answers with "not modified", without sending anything.
+
+        Returns a tuple of the list of changed events, a new sync token and
+        the new ETag.  Raises SyncTokenExpired if google no longer accepts
+        the sync token.
+
+        """
+        from apiclient.errors import HttpError
+        print("Syncing calendar for %s" % (calendar_summary, ))
+        try:
+            return self._list_events(
+                self.service.calendar_id(calendar_summary),
+                etag=etag,
+                syncToken=sync_token,
+            )
+        except HttpError as e:
+            if e.resp.status == 304:
+                return [], sync_token, etag
+            if e.resp.status == 410:
+                raise SyncTokenExpired(calendar_summary)
+            raise
+
+    def fetch_events_between(self, calendar_summary, time_min, time_max):
+        """Fetch the events overlapping a window of time.
+
+        :param time_min: The start of the window, as an RFC3339 time.
+        :param time_max: The end of the window, as an RFC3339 time.
+
+        """
+        print("Fetching calendar for %s" % (calendar_summary, ))
+        events, _, _ = self._list_events(
+            self.service.calendar_id(calendar_summary),
+            timeMin=time_min,
+            timeMax=time_max,
+        )
+        return events
+
+    def _list_events(self, calendar_id, page_token=None, etag=None,
+                     **params):
+        """Fetch all the pages of a list of events.
+
+        :param etag: An ETag to make the request for the first page
+        conditional on; an HttpError with status 304 is raised if it still
+        matches.
+
+        Returns a tuple of the events, the sync token and the ETag.
+
+        """
+        events = []
         while True:
-            results = self.service.events().list(
+            request = self.service.events().list(
                 pageToken=page_token,
                 calendarId=calendar_id,
-                orderBy="startTime",
                 singleEvents=True,
-                timeMin=self.date_min_formatted,
-                timeMax=self.date_max_formatted,
                 timeZone="UTC",
-            ).execute()
-            for event in results['items']:
-                yield event
+                maxResults=events_per_page,
+                fields=events_list_fields,
+                **params
+            )
+            if etag is not None:
+                # Only the request for the first page is conditional.
+                request.headers["If-None-Match"] = etag
+                etag = None
+            results = self.service.execute(request)
+            events.extend(results['items'])
             page_token = results.get('nextPageToken')
             if page_token is None:
-                break
+                return (
+                    events,
+                    results.get('nextSyncToken'),
+                    results.get('etag'),
+                )
 
 
 class CalendarCache(object):
-    def __init__(self, calendar_service, date_min, date_max, cache_dir):
+    def __init__(self, calendar_service, date_min, date_max, cache_dir,
+                 classifier=None, resync=False, memory=None):
+        """A cache of calendars for a window of dates.
+
+        :param resync: If True, check google for changes to calendars even
+        if they were cached for the same window.
+        :param memory: A dict, shared between CalendarCaches, in which
+        parsed calendars are kept.  They are reused without reading the cache
+        file when not resyncing, or without parsing the events again when
+        their fingerprint hasn't changed.
+
+        """
         self.calendar_service = calendar_service
+        self.classifier = classifier
+        self.resync = resync
+        self.memory = memory
         self.date_min_formatted = date_min.isoformat() + "T00:00:00Z"
         self.date_max_formatted = date_max.isoformat() + "T00:00:00Z"
-        self.cache_dir = cache_dir
-        self.calendar_fetcher = CalendarFetcher(
-            calendar_service,
-            self.date_min_formatted,
-            self.date_max_formatted,
+        self.fetch_max_formatted = (
+            (date_max + sync_lookahead).isoformat() + "T00:00:00Z"
         )
+        self.window_start = Event.parse_iso_datetime(
+            self.date_min_formatted, is_start=True)
+        self.window_end = Event.parse_iso_datetime(
+            self.date_max_formatted, is_start=False)
+        self.cache_dir = cache_dir
+        self.calendar_fetcher = self._make_fetcher(calendar_service)
 
         if not os.path.isdir(cache_dir):
             os.makedirs(cache_dir)
 
+    def _make_fetcher(self, calendar_service):
+        return CalendarFetcher(
+            calendar_service,
+            self.date_min_formatted,
+            self.fetch_max_formatted,
+        )
+
     def get(self, calendar_summary):
-        calendar_id = self.calendar_service.calendar_id(calendar_summary)
+        return self._get(calendar_summary, self.calendar_fetcher)
+
+    def get_many(self, calendar_summaries, workers=1):
+        """Get the calendars for several calendar summaries.
+
+        Calendars which aren't in the cache are fetched by up to `workers`
+        threads at once, each with its own connection to google.
+
+        Returns a dict from calendar summary to Calendar.
+
+        """
+        calendar_summaries = sorted(set(calendar_summaries))
+        workers = min(workers, len(calendar_summaries))
+        if workers <= 1:
+            return dict(
+                (calendar_summary, self.get(calendar_summary))
+                for calendar_summary in calendar_summaries
+            )
+
+        queue = Queue.Queue()
+        for calendar_summary in calendar_summaries:
+            queue.put(calendar_summary)
+        results = {}
+        errors = []
+
+        def work(calendar_fetcher):
+            while not errors:
+                try:
+                    calendar_summary = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[calendar_summary] = self._get(
+                        calendar_summary, calendar_fetcher
+                    )
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        threads = [
+            threading.Thread(target=work, args=(
+                self._make_fetcher(self.calendar_service.copy()),
+            ))
+            for _ in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def _get(self, calendar_summary, calendar_fetcher):
+        window = (self.window_start, self.window_end)
+        remembered = None
+        if self.memory is not None:
+            remembered = self.memory.get(calendar_summary)
+            if remembered is not None and remembered[0] != window:
+                remembered = None
+            if remembered is not None and not self.resync:
+                return remembered[1]
+
+        calendar = self._load_calendar(
+            calendar_summary, calendar_fetcher,
+            remembered[1] if remembered is not None else None,
+        )
+        if self.memory is not None:
+            self.memory[calendar_summary] = (window, calendar)
+        return calendar
+
+    def _load_calendar(self, calendar_summary, calendar_fetcher,
+                       remembered=None):
+        """Load a calendar from the cache, fetching changes from google as
+        needed.
+
+        :param remembered: A Calendar parsed earlier for the same window,
+        which is returned instead of parsing the events again if they haven't
+        changed.
+
+        """
+        data, fingerprint, calendar_id = self._fetch_events(
+            calendar_summary, calendar_fetcher)
+        if (
+            remembered is not None and fingerprint is not None and
+            remembered.fingerprint == fingerprint
+        ):
+            return remembered
+        events = (
+            Event(event, True, calendar_id, self.classifier)
+            for event in data
+        )
         return Calendar(
             calendar_summary,
             [
-                Event(event, True, calendar_id)
-                for event in self._fetch_events(calendar_summary)
+                event for event in events
+                if event.intersects_with(self.window_start, self.window_end)
             ],
+            fingerprint,
         )
 
-    def _fetch_events(self, calendar_summary):
+    def _cache_path(self, calendar_summary):
+        """Return the path of the cache for a calendar, without extension."""
         slug = re.sub("[^a-z0-9]", "_", calendar_summary.lower())
-        path = os.path.join(self.cache_dir, slug)
+        return os.path.join(self.cache_dir, slug)
+
+    def _fetch_events(self, calendar_summary, calendar_fetcher):
+        """Get the raw events for a calendar, a fingerprint of them, and the
+        calendar's id.
+
+        The cache file holds all the events from the start of the window to
+        `sync_lookahead` beyond its end, and a sync token.  If the window has
+        moved on since the cache was written, but is still inside the range
+        that was fetched, only the changes since then are fetched from
+        google.  Otherwise, all the events are fetched again.
+
+        The fingerprint is kept in the cache file, and only changes when
+        google reports changes to the events.  The calendar's id is kept
+        there too, so that the list of calendars doesn't need fetching when
+        everything is cached, as is the ETag of its events, so that google
+        can answer a sync with "not modified" if nothing has changed.
+
+        """
+        path = self._cache_path(calendar_summary)
+        data = None
         if os.path.exists(path + ".json"):
             with open(path + ".json", "rb") as fobj:
                 data = json.load(fobj)
-                if (
-                    data["date_min"] == self.date_min_formatted and
-                    data["date_max"] == self.date_max_formatted
-                ):
-                    return data["data"]
+            if (
+                not self.resync and
+                data["date_min"] == self.date_min_formatted and
+                data["date_max"] == self.date_max_formatted
+            ):
+                calendar_id = data.get("calendar_id")
+                if calendar_id is None:
+                    calendar_id = self.calendar_service.calendar_id(
+                        calendar_summary)
+                return data["data"], data.get("fingerprint"), calendar_id
+
+        result = None
+        if (
+            data is not None and
+            data.get("sync_token") is not None and
+            data["fetched_min"] <= self.date_min_formatted and
+            data["fetched_max"] >= self.date_max_formatted
+        ):
+            try:
+                result, sync_token, etag, changed = self._sync_events(
+                    calendar_summary, calendar_fetcher, data
+                )
+                fetched_max = data["fetched_max"]
+                fingerprint = data.get("fingerprint")
+                if changed or fingerprint is None:
+                    fingerprint = events_fingerprint(result)
+            except SyncTokenExpired:
+                pass
+        if result is None:
+            result, sync_token, etag = calendar_fetcher.fetch_events(
+                calendar_summary)
+            fetched_max = self.fetch_max_formatted
+            fingerprint = events_fingerprint(result)
 
-        result = self.calendar_fetcher.fetch_events(calendar_summary)
+        calendar_id = self.calendar_service.calendar_id(calendar_summary)
         with open(path + ".tmp", "wb") as fobj:
             json.dump({
+                "calendar_id": calendar_id,
                 "date_min": self.date_min_formatted,
                 "date_max": self.date_max_formatted,
+                "fetched_min": self.date_min_formatted,
+                "fetched_max": fetched_max,
+                "sync_token": sync_token,
+                "etag": etag,
+                "fingerprint": fingerprint,
                 "data": result,
             }, fobj)
         os.rename(path + ".tmp", path + ".json")
-        return result
+        return result, fingerprint, calendar_id
+
+    def _sync_events(self, calendar_summary, calendar_fetcher, data):
+        """Apply the changes since the cache was written to its events.
+
+        Events which have been deleted, or have moved out of the fetched
+        range, are removed, as are events which ended before the start of the
+        window.
+
+        Returns a tuple of the updated list of events, the new sync token,
+        the new ETag, and whether there were any changes.
+
+        """
+        changes, sync_token, etag = calendar_fetcher.fetch_changes(
+            calendar_summary, data["sync_token"], data.get("etag")
+        )
+        range_start = self.window_start
+        range_end = Event.parse_iso_datetime(data["fetched_max"], is_start=False)
+        events = OrderedDict(
+            (event["id"], event)
+            for event in data["data"]
+        )
+        for event in changes:
+            if event.get("status") == "cancelled":
+                events.pop(event["id"], None)
+            else:
+                events[event["id"]] = event
+        return [
+            event
+            for event in events.values()
+            if event_in_range(event, range_start, range_end)
+        ], sync_token, etag, len(changes) > 0
+
+
@@ -1,3 +1,13 @@
+import time
+
+from rate_limit import backoff_delay, is_duplicate, is_retryable
+
+# Number of events to create in each batch request.  Google recommends no more
+# than 50 requests in a batch to the calendar API.
+default_batch_size = 50
+
+# Number of times to try creating an event before giving up.
+max_attempts = 5
 
 
 class CalendarSetter(object):
@@ -5,11 +15,96 @@ class CalendarSetter(object):
         self.service = service
 
     def add_event(self, calendar_summary, event_data):
-        event = self.service.events().insert(
-            calendarId=self.service.calendar_id(calendar_summary),
-            sendNotifications=True,
-            body=event_data,
-        ).execute()
+        from apiclient.errors import HttpError
+        try:
+            event = self.service.execute(self.service.events().insert(
+                calendarId=self.service.calendar_id(calendar_summary),
+                sendNotifications=True,
+                body=event_data,
+            ))
+        except HttpError as e:
+            if not is_duplicate(e):
+                raise
+            print 'Event already exists: {}'.format(event_data.get('id'))
+            return
         print 'Event created: {}'.format(
             event.get('htmlLink'),
         )
+
+    def add_events(self, calendar_summary, events_data,
+                   batch_size=default_batch_size):
+        """Create several events, using batch requests.
+
+        Events which fail to be created with an error which might be temporary
+        (eg, hitting a rate limit) are retried, with exponential backoff, and
+        rate limit errors lower the number of requests made at once.  Events
+        should be given ids, so that one which google refuses as a duplicate
+        of its id, because an earlier attempt created it after all, is taken
+        as created rather than created twice.
+
+        Returns a list of the created events, in the same order as
+        events_data, with None in place of any which couldn't be created.
+
+        """
+        calendar_id = self.service.calendar_id(calendar_summary)
+        created = [None] * len(events_data)
+        pending = range(len(events_data))
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                time.sleep(backoff_delay(attempt))
+            failures = []
+            for start in range(0, len(pending), batch_size):
+                failures.extend(self._insert_batch(
+                    calendar_id,
+                    events_data,
+                    pending[start:start + batch_size],
+                    created,
+                ))
+            pending = []
+            for index, error in failures:
+                self.service.executor.record_failure(error)
+                if is_retryable(error) and attempt + 1 < max_attempts:
+                    pending.append(index)
+                    self.service.traffic.count_retry()
+                else:
+                    print 'Failed to create event at {}: {}'.format(
+                        events_data[index]["start"]["dateTime"],
+                        error,
+                    )
+            if not pending:
+                break
+        return created
+
+    def _insert_batch(self, calendar_id, events_data, indexes, created):
+        """Insert some events in a single batch request.
+
+        Stores the created events in `created`, and returns a list of
+        (index, exception) for the events which failed.
+
+        """
+        failures = []
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            if exception is None:
+                created[index] = response
+                print 'Event created: {}'.format(
+                    response.get('htmlLink'),
+                )
+            elif is_duplicate(exception):
+                created[index] = events_data[index]
+                print 'Event already exists: {}'.format(
+                    events_data[index].get('id'),
+                )
+            else:
+                failures.append((index, exception))
+
+        batch = self.service.new_batch(callback)
+        for index in indexes:
+            batch.add(self.service.events().insert(
+                calendarId=calendar_id,
+                sendNotifications=True,
+                body=events_data[index],
+            ), request_id=str(index))
+        self.service.execute(batch, cost=len(indexes))
+        return failures
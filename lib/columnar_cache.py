@@ -0,0 +1,439 @@
+"""A compact, columnar cache of calendars.
+
+The JSON calendar cache keeps every event as google returned it, so each run
+has to decode the whole file and build an Event for every event again.
+ColumnarCalendarCache keeps only what the allocator uses, with a numpy array
+saved in a .npy file for each column:
+
+ - start and end times, in seconds since the epoch
+ - classification flags, and the number of accepted attendees
+ - whether the event is busy time or optional, and the owner's response
+ - the event's id and summary, and the email and response of each attendee,
+   as indexes into a table of strings
+
+Loading a calendar memory-maps the arrays, so nothing is decoded until it is
+used: conflict levels are calculated straight from the arrays, and the table
+of strings is only read if the events themselves are asked for.
+
+The flags are calculated with the cache's classifier when the events are
+written, so remove the cache after changing how events are classified.
+
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+from calendar_fetcher import (
+    ATTENDEE_CONFLICT_LEVELS,
+    BLOCKING,
+    BUSY_ACCEPTED,
+    PREFERRED,
+    CalendarCache,
+    Event,
+    SyncTokenExpired,
+)
+from conflict_matrix import epoch, timestamp
+
+# Version of the cache format.  Caches from other versions are fetched again.
+columns_version = 1
+
+# The column for each field of an event, and its type.
+event_columns = [
+    ("start", numpy.int64),
+    ("end", numpy.int64),
+    ("flags", numpy.int8),
+    ("accepted", numpy.int32),
+    ("busy", numpy.int8),
+    ("optional", numpy.int8),
+    ("response", numpy.int32),
+    ("id", numpy.int32),
+    ("summary", numpy.int32),
+]
+
+# The running maximum of the end times of the events, for finding the events
+# overlapping a time with a binary search.
+index_columns = [
+    ("max_end", numpy.int64),
+]
+
+# The columns for the attendees of the events: the attendees of event i are
+# at positions attendee_offsets[i] to attendee_offsets[i + 1] of the others.
+attendee_columns = [
+    ("attendee_offsets", numpy.int32),
+    ("attendee_emails", numpy.int32),
+    ("attendee_responses", numpy.int32),
+]
+
+
+def event_record(event):
+    """Return the fields of an Event which are kept in the cache, as a tuple
+    in the order of event_columns, followed by a list of (email, response)
+    for its attendees.
+
+    """
+    return (
+        timestamp(event.start),
+        timestamp(event.end),
+        event.flags,
+        event.accepted_count,
+        int(event.busy),
+        int(event.optional),
+        event.response_status,
+        event.id or u"",
+        event.summary,
+        [
+            (email, response)
+            for response, emails in sorted(event.attendees.items())
+            for email in emails
+        ],
+    )
+
+
+class StringTable(object):
+    """Strings stored once each, and referred to by their index."""
+
+    def __init__(self):
+        self.strings = []
+        self._indexes = {}
+
+    def index(self, value):
+        result = self._indexes.get(value)
+        if result is None:
+            result = len(self.strings)
+            self.strings.append(value)
+            self._indexes[value] = result
+        return result
+
+
+class ColumnarEvents(object):
+    def __init__(self, path, meta, columns):
+        """The events saved in a columnar cache directory.
+
+        :param meta: The dict saved in meta.json: the window and range of
+        dates fetched, the sync token and the fingerprint of the events.
+        :param columns: The arrays, by column name.  Events are in order of
+        start time.
+
+        """
+        self.path = path
+        self.meta = meta
+        self.columns = columns
+        self._strings = None
+
+    @staticmethod
+    def load(path):
+        """Load the events from a cache directory, memory-mapping the arrays.
+
+        Returns None if there is no usable cache there.
+
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "rb") as fobj:
+            meta = json.load(fobj)
+        if meta.get("version") != columns_version:
+            return None
+        columns = dict(
+            (name, numpy.load(
+                os.path.join(path, name + ".npy"), mmap_mode="r"))
+            for name, _ in event_columns + index_columns + attendee_columns
+        )
+        return ColumnarEvents(path, meta, columns)
+
+    @staticmethod
+    def save(path, meta, records):
+        """Save events, given as records from event_record, to a cache
+        directory, replacing any events already there.
+
+        """
+        records = sorted(records)
+        strings = StringTable()
+        values = dict((name, []) for name, _ in event_columns)
+        offsets = [0]
+        attendee_emails = []
+        attendee_responses = []
+        for record in records:
+            for (name, _), value in zip(event_columns, record):
+                if name in ("response", "id", "summary"):
+                    value = strings.index(value)
+                values[name].append(value)
+            for email, response in record[-1]:
+                attendee_emails.append(strings.index(email))
+                attendee_responses.append(strings.index(response))
+            offsets.append(len(attendee_emails))
+        values["max_end"] = []
+        max_end = None
+        for end in values["end"]:
+            if max_end is None or end > max_end:
+                max_end = end
+            values["max_end"].append(max_end)
+        values["attendee_offsets"] = offsets
+        values["attendee_emails"] = attendee_emails
+        values["attendee_responses"] = attendee_responses
+
+        digest = hashlib.sha1()
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, dtype in event_columns + index_columns + attendee_columns:
+            array = numpy.array(values[name], dtype=dtype)
+            digest.update(array.tostring())
+            numpy.save(os.path.join(tmp_path, name + ".npy"), array)
+        strings_data = json.dumps(strings.strings)
+        digest.update(strings_data)
+        with open(os.path.join(tmp_path, "strings.json"), "wb") as fobj:
+            fobj.write(strings_data)
+
+        meta = dict(meta, version=columns_version)
+        if meta.get("fingerprint") is None:
+            meta["fingerprint"] = digest.hexdigest()
+        with open(os.path.join(tmp_path, "meta.json"), "wb") as fobj:
+            json.dump(meta, fobj)
+
+        # A directory can't be renamed over another, so move the old one out
+        # of the way first.
+        old_path = path + ".old"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        return ColumnarEvents.load(path)
+
+    def __len__(self):
+        return len(self.columns["start"])
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            with open(os.path.join(self.path, "strings.json"), "rb") as fobj:
+                self._strings = json.load(fobj)
+        return self._strings
+
+    def record(self, index):
+        """Return the record for an event, as from event_record."""
+        strings = self.strings
+        columns = self.columns
+        values = []
+        for name, _ in event_columns:
+            value = columns[name][index]
+            if name in ("response", "id", "summary"):
+                values.append(strings[value])
+            else:
+                values.append(int(value))
+        first = columns["attendee_offsets"][index]
+        last = columns["attendee_offsets"][index + 1]
+        values.append([
+            (strings[email], strings[response])
+            for email, response in zip(
+                columns["attendee_emails"][first:last],
+                columns["attendee_responses"][first:last],
+            )
+        ])
+        return tuple(values)
+
+    def records(self):
+        return [self.record(index) for index in range(len(self))]
+
+
+class CachedEvent(Event):
+    def __init__(self, record):
+        """An Event rebuilt from a record in a columnar cache."""
+        (start, end, flags, accepted, busy, optional, response, event_id,
+         summary, attendees) = record
+        self.is_saved = True
+        self.id = event_id or None
+        self.start = epoch + datetime.timedelta(seconds=start)
+        self.end = epoch + datetime.timedelta(seconds=end)
+        self.summary = summary
+        self.description = ""
+        self.attendees = {}
+        for email, attendee_response in attendees:
+            self.attendees.setdefault(attendee_response, []).append(email)
+        self.busy = bool(busy)
+        self.response_status = response
+        self.optional = bool(optional)
+        self.accepted_count = accepted
+        self.flags = flags
+
+
+class ColumnarCalendar(object):
+    def __init__(self, calendar_summary, stored, window_end):
+        """A calendar whose events are kept in a columnar cache.
+
+        Works like a Calendar, but only builds Event objects when they are
+        asked for.
+
+        :param stored: The ColumnarEvents.  Events starting at or after
+        window_end are ignored.
+
+        """
+        self.calendar_summary = calendar_summary
+        self.stored = stored
+        self.fingerprint = stored.meta["fingerprint"]
+        columns = stored.columns
+        self._count = int(numpy.searchsorted(
+            columns["start"], timestamp(window_end), side="left"))
+        self._starts = columns["start"][:self._count]
+        self._ends = columns["end"][:self._count]
+        self._flags = columns["flags"][:self._count]
+        self._accepted = columns["accepted"][:self._count]
+        self._max_ends = columns["max_end"][:self._count]
+        self._events = None
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = [
+                CachedEvent(self.stored.record(index))
+                for index in range(self._count)
+            ]
+        return self._events
+
+    def encoded(self):
+        """Return the events which affect conflict levels, encoded as by
+        conflict_matrix.encode_calendar.
+
+        """
+        flagged = self._flags != 0
+        return (
+            numpy.asarray(self._starts[flagged]),
+            numpy.asarray(self._ends[flagged]),
+            numpy.asarray(self._flags[flagged]),
+            numpy.asarray(self._accepted[flagged]),
+        )
+
+    def _overlapping(self, start, end):
+        """Return the indexes of the events overlapping a time."""
+        start = timestamp(start)
+        end = timestamp(end)
+        hi = int(numpy.searchsorted(self._starts, end, side="left"))
+        lo = int(numpy.searchsorted(self._max_ends[:hi], start, side="right"))
+        return lo + numpy.nonzero(self._ends[lo:hi] > start)[0]
+
+    def intersecting_events(self, start, end):
+        events = self.events
+        return [events[index] for index in self._overlapping(start, end)]
+
+    def conflict_level(self, start, end):
+        """Return a level indicating the amount of conflict for a slot, as
+        Calendar.conflict_level does.
+
+        """
+        overlapping = self._overlapping(start, end)
+        flags = self._flags[overlapping]
+        if (flags & BLOCKING).any():
+            return None
+        if (flags & PREFERRED).any():
+            return 0
+        busy = (flags & BUSY_ACCEPTED) != 0
+        max_attendees = 0
+        if busy.any():
+            max_attendees = int(self._accepted[overlapping][busy].max())
+        return ATTENDEE_CONFLICT_LEVELS[min(max_attendees, 3)]
+
+
+class ColumnarCalendarCache(CalendarCache):
+    """A CalendarCache keeping calendars in the columnar format."""
+
+    def _load_calendar(self, calendar_summary, calendar_fetcher,
+                       remembered=None):
+        path = self._cache_path(calendar_summary) + ".columns"
+        stored = ColumnarEvents.load(path)
+        if stored is not None:
+            meta = stored.meta
+            if (
+                not self.resync and
+                meta["date_min"] == self.date_min_formatted and
+                meta["date_max"] == self.date_max_formatted
+            ):
+                return self._calendar(calendar_summary, stored, remembered)
+
+        records = None
+        fingerprint = None
+        if (
+            stored is not None and
+            stored.meta.get("sync_token") is not None and
+            stored.meta["fetched_min"] <= self.date_min_formatted and
+            stored.meta["fetched_max"] >= self.date_max_formatted
+        ):
+            try:
+                records, sync_token, etag, changed = self._sync_records(
+                    calendar_summary, calendar_fetcher, stored
+                )
+                fetched_max = stored.meta["fetched_max"]
+                if not changed:
+                    fingerprint = stored.meta["fingerprint"]
+            except SyncTokenExpired:
+                pass
+        if records is None:
+            data, sync_token, etag = calendar_fetcher.fetch_events(
+                calendar_summary)
+            records = [self._record(calendar_summary, event) for event in data]
+            fetched_max = self.fetch_max_formatted
+
+        window_start = timestamp(self.window_start)
+        stored = ColumnarEvents.save(path, {
+            "date_min": self.date_min_formatted,
+            "date_max": self.date_max_formatted,
+            "fetched_min": self.date_min_formatted,
+            "fetched_max": fetched_max,
+            "sync_token": sync_token,
+            "etag": etag,
+            "fingerprint": fingerprint,
+        }, [
+            record for record in records
+            if record[1] > window_start
+        ])
+        return self._calendar(calendar_summary, stored, remembered)
+
+    def _calendar(self, calendar_summary, stored, remembered):
+        if (
+            remembered is not None and
+            remembered.fingerprint == stored.meta["fingerprint"]
+        ):
+            return remembered
+        return ColumnarCalendar(calendar_summary, stored, self.window_end)
+
+    def _record(self, calendar_summary, data):
+        return event_record(Event(
+            data, True,
+            self.calendar_service.calendar_id(calendar_summary),
+            self.classifier,
+        ))
+
+    def _sync_records(self, calendar_summary, calendar_fetcher, stored):
+        """Apply the changes since the cache was written to its events.
+
+        Returns a tuple of the updated records, the new sync token, the new
+        ETag, and whether there were any changes.
+
+        """
+        changes, sync_token, etag = calendar_fetcher.fetch_changes(
+            calendar_summary, stored.meta["sync_token"],
+            stored.meta.get("etag"),
+        )
+        range_end = timestamp(Event.parse_iso_datetime(
+            stored.meta["fetched_max"], is_start=False))
+        records = dict(
+            (record[7], record)
+            for record in stored.records()
+        )
+        for event in changes:
+            if event.get("status") == "cancelled":
+                records.pop(event["id"], None)
+            else:
+                records[event["id"]] = self._record(calendar_summary, event)
+        return [
+            record for record in records.values()
+            if record[0] < range_end
+        ], sync_token, etag, len(changes) > 0
@@ -0,0 +1,154 @@
+"""Compute the conflict levels of every interviewer for every slot at once.
+
+Each calendar's events are encoded as arrays of start and end times,
+classification flags and accepted attendee counts, and the overlaps with all
+the slots are found and reduced to conflict levels in a few numpy operations.
+The levels are the same as those from Calendar.conflict_level, except that
+times which aren't available at all are given the level UNAVAILABLE rather
+than None.
+
+"""
+
+import datetime
+import numpy
+import pytz
+
+from calendar_fetcher import (
+    ATTENDEE_CONFLICT_LEVELS,
+    BLOCKING,
+    BUSY_ACCEPTED,
+    PREFERRED,
+)
+
+# Conflict level used in the matrix for times which aren't available at all.
+UNAVAILABLE = -1
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def timestamp(value):
+    """Convert a timezone-aware datetime to seconds since the epoch."""
+    return int((value - epoch).total_seconds())
+
+
+def encode_calendar(calendar):
+    """Encode the events of a calendar which affect conflict levels.
+
+    Returns a tuple of arrays: start and end timestamps, classification
+    flags and accepted attendee counts.  Events with no classification flags
+    can't change the conflict level, so they are left out.
+
+    """
+    encoded = getattr(calendar, "encoded", None)
+    if encoded is not None:
+        # Calendars from the columnar cache are already encoded.
+        return encoded()
+    events = [event for event in calendar.events if event.flags]
+    return (
+        numpy.array([timestamp(event.start) for event in events],
+                    dtype=numpy.int64),
+        numpy.array([timestamp(event.end) for event in events],
+                    dtype=numpy.int64),
+        numpy.array([event.flags for event in events], dtype=numpy.int8),
+        numpy.array([event.accepted_count for event in events],
+                    dtype=numpy.int32),
+    )
+
+
+class ConflictMatrix(object):
+    def __init__(self, interviewers, slots):
+        """Calculate the conflict levels for some interviewers and slots.
+
+        :param interviewers: The Interviewer objects, with calendars loaded.
+        :param slots: The Slot objects.
+
+        `levels` is then an array with a row for each interviewer and a column
+        for each slot, in the order supplied.
+
+        """
+        self.interviewers = list(interviewers)
+        self.slots = list(slots)
+        self.levels = self.compute(
+            [encode_calendar(person.calendar) for person in self.interviewers],
+            numpy.array([timestamp(slot.start) for slot in self.slots],
+                        dtype=numpy.int64),
+            numpy.array([timestamp(slot.end) for slot in self.slots],
+                        dtype=numpy.int64),
+        )
+
+    def level(self, interviewer_index, slot_index):
+        """Return the conflict level for one person and slot, or None if the
+        time isn't available for them.
+
+        """
+        level = int(self.levels[interviewer_index, slot_index])
+        if level == UNAVAILABLE:
+            return None
+        return level
+
+    @staticmethod
+    def compute(calendars, slot_starts, slot_ends):
+        """Calculate the matrix of conflict levels.
+
+        :param calendars: A list of encoded calendars, one per row, as
+        returned by encode_calendar.
+        :param slot_starts: Array of slot start timestamps, one per column.
+        :param slot_ends: Array of slot end timestamps.
+
+        """
+        levels = numpy.empty((len(calendars), len(slot_starts)),
+                             dtype=numpy.int16)
+        levels.fill(ATTENDEE_CONFLICT_LEVELS[0])
+        if len(calendars) == 0 or len(slot_starts) == 0:
+            return levels
+
+        owners = numpy.concatenate([
+            numpy.repeat(row, len(calendar[0]))
+            for row, calendar in enumerate(calendars)
+        ]).astype(numpy.int64)
+        starts, ends, flags, accepted = [
+            numpy.concatenate([calendar[i] for calendar in calendars])
+            for i in range(4)
+        ]
+
+        # Find the range of slots which each event might overlap, using the
+        # slots ordered by start time, and the running maximum of their end
+        # times.
+        order = numpy.argsort(slot_starts, kind="mergesort")
+        sorted_starts = slot_starts[order]
+        max_ends = numpy.maximum.accumulate(slot_ends[order])
+        hi = numpy.searchsorted(sorted_starts, ends, side="left")
+        lo = numpy.searchsorted(max_ends, starts, side="right")
+        counts = numpy.maximum(hi - lo, 0)
+
+        # Expand to one entry per (event, slot) pair, and keep the pairs which
+        # really overlap.
+        event_index = numpy.repeat(numpy.arange(len(starts)), counts)
+        first_pair = numpy.cumsum(counts) - counts
+        slot_index = order[
+            lo[event_index] +
+            numpy.arange(len(event_index)) - first_pair[event_index]
+        ]
+        overlapping = slot_ends[slot_index] > starts[event_index]
+        event_index = event_index[overlapping]
+        slot_index = slot_index[overlapping]
+        rows = owners[event_index]
+        pair_flags = flags[event_index]
+
+        busy = (pair_flags & BUSY_ACCEPTED) != 0
+        max_attendees = numpy.zeros(levels.shape, dtype=numpy.int32)
+        numpy.maximum.at(
+            max_attendees,
+            (rows[busy], slot_index[busy]),
+            accepted[event_index[busy]],
+        )
+        levels[:] = numpy.array(ATTENDEE_CONFLICT_LEVELS)[
+            numpy.minimum(max_attendees, len(ATTENDEE_CONFLICT_LEVELS) - 1)
+        ]
+
+        preferred = (pair_flags & PREFERRED) != 0
+        levels[rows[preferred], slot_index[preferred]] = 0
+
+        blocking = (pair_flags & BLOCKING) != 0
+        levels[rows[blocking], slot_index[blocking]] = UNAVAILABLE
+        return levels
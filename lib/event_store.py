@@ -0,0 +1,387 @@
+"""Keep cached calendars in a SQLite database.
+
+All the calendars are kept in one database file, shared by every
+SqliteCalendarCache using the same cache directory, so the slot generator and
+the interviewers' calendars use the same store.  Each event is stored with
+its start and end times, classification flags and accepted attendee count,
+indexed by calendar and time, so:
+
+ - conflict levels for a slot are found with a range query, without parsing
+   any events
+ - events are only parsed when they overlap a time being asked about
+ - changes from an incremental sync are applied as upserts and deletes,
+   rather than rewriting a whole file
+
+The database uses write-ahead logging, so threads can read calendars while
+another is syncing.  Each thread gets its own connection.
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+import numpy
+
+from calendar_fetcher import (
+    ATTENDEE_CONFLICT_LEVELS,
+    BLOCKING,
+    BUSY_ACCEPTED,
+    PREFERRED,
+    CalendarCache,
+    Event,
+    SyncTokenExpired,
+    events_fingerprint,
+)
+from conflict_matrix import timestamp
+
+# Seconds to wait for another thread or process to finish writing.
+busy_timeout = 30
+
+schema = """
+CREATE TABLE IF NOT EXISTS calendars (
+    summary TEXT PRIMARY KEY,
+    calendar_id TEXT,
+    etag TEXT,
+    date_min TEXT NOT NULL,
+    date_max TEXT NOT NULL,
+    fetched_min TEXT NOT NULL,
+    fetched_max TEXT NOT NULL,
+    sync_token TEXT,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    calendar TEXT NOT NULL,
+    id TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    flags INTEGER NOT NULL,
+    accepted INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (calendar, id)
+);
+CREATE INDEX IF NOT EXISTS events_by_time
+    ON events (calendar, start_time, end_time);
+"""
+
+
+class EventStore(object):
+    def __init__(self, path):
+        """A SQLite database of calendar events.
+
+        :param path: The database file, which is created if needed.
+
+        """
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.executescript(schema)
+
+    def connection(self):
+        """Return this thread's connection to the database."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=busy_timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def calendar(self, calendar_summary):
+        """Return a dict of what is stored about a calendar (its id, window,
+        range of dates fetched, sync token, ETag and fingerprint), or None.
+
+        """
+        cursor = self.connection().execute(
+            "SELECT calendar_id, date_min, date_max, fetched_min, "
+            "fetched_max, sync_token, etag, fingerprint FROM calendars "
+            "WHERE summary = ?",
+            (calendar_summary,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ("calendar_id", "date_min", "date_max", "fetched_min",
+             "fetched_max", "sync_token", "etag", "fingerprint"),
+            row,
+        ))
+
+    def replace(self, calendar_summary, info, events):
+        """Replace all the stored events of a calendar.
+
+        :param info: A dict of what to store about the calendar, as returned
+        by calendar().
+        :param events: A list of (raw event data, Event) pairs.
+
+        """
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM events WHERE calendar = ?", (calendar_summary,))
+            self._upsert(connection, calendar_summary, events)
+            self._set_calendar(connection, calendar_summary, info)
+
+    def update(self, calendar_summary, info, changed, deleted, range_start,
+               range_end):
+        """Apply changes from an incremental sync to a calendar.
+
+        :param changed: A list of (raw event data, Event) pairs for the
+        events which were added or changed.
+        :param deleted: The ids of the events which were deleted.
+        :param range_start: Events ending at or before this time, in
+        seconds since the epoch, are removed.
+        :param range_end: Events starting at or after this time are removed.
+
+        """
+        with self.connection() as connection:
+            connection.executemany(
+                "DELETE FROM events WHERE calendar = ? AND id = ?",
+                [(calendar_summary, event_id) for event_id in deleted],
+            )
+            self._upsert(connection, calendar_summary, changed)
+            connection.execute(
+                "DELETE FROM events WHERE calendar = ? AND "
+                "(end_time <= ? OR start_time >= ?)",
+                (calendar_summary, range_start, range_end),
+            )
+            self._set_calendar(connection, calendar_summary, info)
+
+    @staticmethod
+    def _upsert(connection, calendar_summary, events):
+        connection.executemany(
+            "INSERT OR REPLACE INTO events (calendar, id, start_time, "
+            "end_time, flags, accepted, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    calendar_summary,
+                    data["id"],
+                    timestamp(event.start),
+                    timestamp(event.end),
+                    event.flags,
+                    event.accepted_count,
+                    json.dumps(data),
+                )
+                for data, event in events
+            ],
+        )
+
+    @staticmethod
+    def _set_calendar(connection, calendar_summary, info):
+        connection.execute(
+            "INSERT OR REPLACE INTO calendars (summary, calendar_id, "
+            "date_min, date_max, fetched_min, fetched_max, sync_token, "
+            "etag, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                calendar_summary,
+                info["calendar_id"],
+                info["date_min"],
+                info["date_max"],
+                info["fetched_min"],
+                info["fetched_max"],
+                info["sync_token"],
+                info["etag"],
+                info["fingerprint"],
+            ),
+        )
+
+    def overlapping(self, calendar_summary, start, end, columns):
+        """Return the values of some columns for the events of a calendar
+        which overlap the time from start to end, in order of start time.
+
+        Times are in seconds since the epoch.
+
+        """
+        return self.connection().execute(
+            "SELECT {} FROM events WHERE calendar = ? AND "
+            "start_time < ? AND end_time > ? "
+            "ORDER BY start_time".format(", ".join(columns)),
+            (calendar_summary, end, start),
+        ).fetchall()
+
+
+class SqliteCalendar(object):
+    def __init__(self, calendar_summary, calendar_id, store, fingerprint,
+                 window_start, window_end, classifier=None):
+        """A calendar whose events are kept in an EventStore.
+
+        Works like a Calendar, but queries the store rather than holding the
+        events in memory.  Only events overlapping the window are used.
+
+        """
+        self.calendar_summary = calendar_summary
+        self.calendar_id = calendar_id
+        self.store = store
+        self.fingerprint = fingerprint
+        self.window_start = timestamp(window_start)
+        self.window_end = timestamp(window_end)
+        self.classifier = classifier
+
+    def _overlapping(self, start, end, columns):
+        return self.store.overlapping(
+            self.calendar_summary,
+            max(start, self.window_start),
+            min(end, self.window_end),
+            columns,
+        )
+
+    def _events(self, start, end):
+        return [
+            Event(json.loads(data), True, self.calendar_id, self.classifier)
+            for (data,) in self._overlapping(start, end, ["data"])
+        ]
+
+    @property
+    def events(self):
+        return self._events(self.window_start, self.window_end)
+
+    def intersecting_events(self, start, end):
+        return self._events(timestamp(start), timestamp(end))
+
+    def encoded(self):
+        """Return the events which affect conflict levels, encoded as by
+        conflict_matrix.encode_calendar.
+
+        """
+        rows = [
+            row for row in self._overlapping(
+                self.window_start, self.window_end,
+                ["start_time", "end_time", "flags", "accepted"],
+            )
+            if row[2]
+        ]
+        return tuple(
+            numpy.array([row[column] for row in rows], dtype=dtype)
+            for column, dtype in enumerate(
+                (numpy.int64, numpy.int64, numpy.int8, numpy.int32))
+        )
+
+    def conflict_level(self, start, end):
+        """Return a level indicating the amount of conflict for a slot, as
+        Calendar.conflict_level does.
+
+        """
+        max_attendees = 0
+        is_preferred = False
+        for flags, accepted in self._overlapping(
+                timestamp(start), timestamp(end), ["flags", "accepted"]):
+            if flags & PREFERRED:
+                is_preferred = True
+            elif flags & BLOCKING:
+                return None
+            elif flags & BUSY_ACCEPTED:
+                if accepted > max_attendees:
+                    max_attendees = accepted
+        if is_preferred:
+            return 0
+        return ATTENDEE_CONFLICT_LEVELS[min(max_attendees, 3)]
+
+
+class SqliteCalendarCache(CalendarCache):
+    """A CalendarCache keeping calendars in an EventStore.
+
+    The flags of each event are calculated with the cache's classifier when
+    it is stored, so remove the database after changing how events are
+    classified.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(SqliteCalendarCache, self).__init__(*args, **kwargs)
+        self.store = EventStore(os.path.join(self.cache_dir, "events.sqlite3"))
+
+    def _load_calendar(self, calendar_summary, calendar_fetcher,
+                       remembered=None):
+        info = self.store.calendar(calendar_summary)
+        if (
+            info is None or self.resync or
+            info["date_min"] != self.date_min_formatted or
+            info["date_max"] != self.date_max_formatted
+        ):
+            info = self._fetch(calendar_summary, calendar_fetcher, info)
+        if (
+            remembered is not None and
+            remembered.fingerprint == info["fingerprint"]
+        ):
+            return remembered
+        calendar_id = info["calendar_id"]
+        if calendar_id is None:
+            calendar_id = self.calendar_service.calendar_id(calendar_summary)
+        return SqliteCalendar(
+            calendar_summary, calendar_id, self.store, info["fingerprint"],
+            self.window_start, self.window_end, self.classifier,
+        )
+
+    def _fetch(self, calendar_summary, calendar_fetcher, info):
+        """Bring the stored events of a calendar up to date, syncing changes
+        if the stored events still cover the window.
+
+        Returns the new information about the calendar.
+
+        """
+        calendar_id = self.calendar_service.calendar_id(calendar_summary)
+        if (
+            info is not None and
+            info["sync_token"] is not None and
+            info["fetched_min"] <= self.date_min_formatted and
+            info["fetched_max"] >= self.date_max_formatted
+        ):
+            try:
+                changes, sync_token, etag = calendar_fetcher.fetch_changes(
+                    calendar_summary, info["sync_token"], info["etag"]
+                )
+            except SyncTokenExpired:
+                pass
+            else:
+                fingerprint = info["fingerprint"]
+                if changes:
+                    # Changes are only reported once, so chain them onto the
+                    # fingerprint of the events they were applied to.
+                    fingerprint = hashlib.sha1(
+                        fingerprint + events_fingerprint(changes)
+                    ).hexdigest()
+                new_info = dict(
+                    info,
+                    calendar_id=calendar_id,
+                    date_min=self.date_min_formatted,
+                    date_max=self.date_max_formatted,
+                    fetched_min=self.date_min_formatted,
+                    sync_token=sync_token,
+                    etag=etag,
+                    fingerprint=fingerprint,
+                )
+                self.store.update(
+                    calendar_summary,
+                    new_info,
+                    [
+                        (event, Event(event, True, calendar_id,
+                                      self.classifier))
+                        for event in changes
+                        if event.get("status") != "cancelled"
+                    ],
+                    [
+                        event["id"] for event in changes
+                        if event.get("status") == "cancelled"
+                    ],
+                    timestamp(self.window_start),
+                    timestamp(Event.parse_iso_datetime(
+                        info["fetched_max"], is_start=False)),
+                )
+                return new_info
+
+        data, sync_token, etag = calendar_fetcher.fetch_events(
+            calendar_summary)
+        new_info = {
+            "calendar_id": calendar_id,
+            "date_min": self.date_min_formatted,
+            "date_max": self.date_max_formatted,
+            "fetched_min": self.date_min_formatted,
+            "fetched_max": self.fetch_max_formatted,
+            "sync_token": sync_token,
+            "etag": etag,
+            "fingerprint": events_fingerprint(data),
+        }
+        self.store.replace(calendar_summary, new_info, [
+            (event, Event(event, True, calendar_id, self.classifier))
+            for event in data
+        ])
+        return new_info
@@ -0,0 +1,582 @@
+"""A local stand-in for the parts of the google calendar API that we use.
+
+Serves a discovery document, calendarList.list, events.list (with time
+ranges, paging and sync tokens), events.insert (refusing ids already in use,
+as google does) and batch requests, from calendars held in memory, and an
+empty list of bank holidays in place of gov.uk's.  Latency, page size and
+quota errors can be configured, to see how fetching and publishing behave
+with realistic round trip costs and throttling.
+
+Like google, it sends partial responses for requests with a `fields`
+parameter, and compresses responses for clients which accept gzip and
+mention it in their user agent.  Lists of calendars and of events carry an
+ETag, which changes when they do, and requests for their first page with a
+matching If-None-Match header are answered with 304 Not Modified.
+
+Point a CalendarService at it with the base_url parameter (or
+`bin/allocate --api-url`).
+
+"""
+
+import BaseHTTPServer
+import email.parser
+import gzip
+import hashlib
+import json
+import random
+import SocketServer
+import StringIO
+import threading
+import time
+import urllib
+import urlparse
+
+from bank_holidays import bank_holidays_path
+from calendar_fetcher import Event
+from common import appointment_calendar_name
+from rate_limit import TokenBucket
+
+# The id of the calendar which interviews are booked in.
+appointment_calendar_id = "recruitment@group.calendar.google.com"
+
+# Page size used by the API when maxResults isn't given, and the largest it
+# allows.
+default_page_size = 250
+max_page_size = 2500
+
+
+def discovery_document(root_url):
+    """Return a minimal discovery document for the calendar API.
+
+    Only the methods which we use are described.
+
+    """
+    def param(location, type_="string", required=False):
+        result = {"type": type_, "location": location}
+        if required:
+            result["required"] = True
+        return result
+
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "calendar:v3",
+        "name": "calendar",
+        "version": "v3",
+        "protocol": "rest",
+        "rootUrl": root_url,
+        "servicePath": "calendar/v3/",
+        "batchPath": "batch/calendar/v3",
+        "parameters": {
+            "alt": {"type": "string", "location": "query", "default": "json"},
+            "fields": param("query"),
+        },
+        "schemas": {
+            "CalendarList": {"id": "CalendarList", "type": "object"},
+            "Event": {"id": "Event", "type": "object"},
+            "Events": {"id": "Events", "type": "object"},
+        },
+        "resources": {
+            "calendarList": {"methods": {
+                "list": {
+                    "id": "calendar.calendarList.list",
+                    "path": "users/me/calendarList",
+                    "httpMethod": "GET",
+                    "parameters": {
+                        "maxResults": param("query", "integer"),
+                        "pageToken": param("query"),
+                    },
+                    "response": {"$ref": "CalendarList"},
+                },
+            }},
+            "events": {"methods": {
+                "list": {
+                    "id": "calendar.events.list",
+                    "path": "calendars/{calendarId}/events",
+                    "httpMethod": "GET",
+                    "parameters": {
+                        "calendarId": param("path", required=True),
+                        "maxResults": param("query", "integer"),
+                        "orderBy": param("query"),
+                        "pageToken": param("query"),
+                        "showDeleted": param("query", "boolean"),
+                        "singleEvents": param("query", "boolean"),
+                        "syncToken": param("query"),
+                        "timeMax": param("query"),
+                        "timeMin": param("query"),
+                        "timeZone": param("query"),
+                    },
+                    "parameterOrder": ["calendarId"],
+                    "response": {"$ref": "Events"},
+                },
+                "insert": {
+                    "id": "calendar.events.insert",
+                    "path": "calendars/{calendarId}/events",
+                    "httpMethod": "POST",
+                    "parameters": {
+                        "calendarId": param("path", required=True),
+                        "sendNotifications": param("query", "boolean"),
+                    },
+                    "parameterOrder": ["calendarId"],
+                    "request": {"$ref": "Event"},
+                    "response": {"$ref": "Event"},
+                },
+            }},
+        },
+    }
+
+
+def parse_fields(fields):
+    """Parse a partial response field mask, such as "items(id,start)".
+
+    Returns a dict from field name to the mask for the parts of that field to
+    include, or None to include all of it.
+
+    """
+    def parse(position):
+        result = {}
+        name = ""
+        while position < len(fields):
+            char = fields[position]
+            if char == ",":
+                if name:
+                    result[name] = None
+                name = ""
+            elif char == "(":
+                result[name], position = parse(position + 1)
+                name = ""
+            elif char == ")":
+                break
+            else:
+                name += char
+            position += 1
+        if name:
+            result[name] = None
+        return result, position
+    return parse(0)[0]
+
+
+def select_fields(data, mask):
+    """Return the parts of some data selected by a parsed field mask."""
+    if mask is None:
+        return data
+    if isinstance(data, list):
+        return [select_fields(item, mask) for item in data]
+    if isinstance(data, dict):
+        return dict(
+            (name, select_fields(data[name], submask))
+            for name, submask in mask.items()
+            if name in data
+        )
+    return data
+
+
+def error_body(code, reason, message):
+    return {"error": {
+        "code": code,
+        "message": message,
+        "errors": [{"domain": "global", "reason": reason, "message": message}],
+    }}
+
+
+def make_etag(value):
+    return '"{}"'.format(hashlib.sha1(value).hexdigest()[:16])
+
+
+class FakeCalendarStore(object):
+    """The calendars served by the fake server."""
+
+    def __init__(self):
+        self.calendars = {}
+        self.summaries = {}
+        self.sequence = 0
+        # The sequence number of the last change to each calendar.
+        self.modified = {}
+        self._lock = threading.Lock()
+
+    def add_calendar(self, calendar_id, summary=None, events=()):
+        """Add a calendar.  Only calendars with a summary are listed in
+        calendarList.
+
+        """
+        self.calendars[calendar_id] = []
+        self.modified[calendar_id] = self.sequence
+        if summary is not None:
+            self.summaries[calendar_id] = summary
+        for event in events:
+            self.insert(calendar_id, event)
+
+    def insert(self, calendar_id, event, replace=True):
+        """Add an event to a calendar, replacing any event with the same
+        id, as an update or cancellation does.
+
+        :param replace: If False, an event with the same id is kept, as
+        google does when creating events, and None is returned.
+
+        """
+        with self._lock:
+            if not replace and any(
+                other[3]["id"] == event.get("id")
+                for other in self.calendars[calendar_id]
+            ):
+                return None
+            self.sequence += 1
+            event = dict(event)
+            event.setdefault("id", "event{}".format(self.sequence))
+            event.setdefault("status", "confirmed")
+            if "attendees" in event:
+                # Google marks invitations as unanswered.
+                event["attendees"] = [
+                    dict({"responseStatus": "needsAction"}, **attendee)
+                    for attendee in event["attendees"]
+                ]
+            event["htmlLink"] = "http://localhost/event?eid={}".format(
+                event["id"])
+            stored = (
+                self.sequence,
+                Event.parse_date_or_time(event["start"], is_start=True),
+                Event.parse_date_or_time(event["end"], is_start=False),
+                event,
+            )
+            self.calendars[calendar_id] = [
+                other for other in self.calendars[calendar_id]
+                if other[3]["id"] != event["id"]
+            ]
+            self.calendars[calendar_id].append(stored)
+            self.modified[calendar_id] = self.sequence
+            return event
+
+    def etag(self, calendar_id):
+        """Return the ETag of a calendar's events."""
+        with self._lock:
+            modified = self.modified[calendar_id]
+        return make_etag("{}:{}".format(calendar_id, modified))
+
+    def calendar_list_etag(self):
+        return make_etag(json.dumps(sorted(self.summaries.items())))
+
+    def events(self, calendar_id, time_min=None, time_max=None,
+               since=None, show_deleted=False):
+        """Return the events in a calendar, and the current sync sequence.
+
+        Only events overlapping the time range, or changed since the
+        sequence number `since`, are returned.  As in google calendar,
+        cancelled events are only included when syncing, or if
+        `show_deleted` is set.
+
+        """
+        with self._lock:
+            stored = list(self.calendars[calendar_id])
+            sequence = self.sequence
+        return [
+            event
+            for (event_sequence, start, end, event) in stored
+            if (time_min is None or end > time_min) and
+            (time_max is None or start < time_max) and
+            (since is None or event_sequence > since) and
+            (since is not None or show_deleted or
+             event.get("status") != "cancelled")
+        ], sequence
+
+    @staticmethod
+    def from_workload(workload):
+        """Make a store holding the calendars of a SyntheticWorkload, and an
+        appointment calendar with its booked slots.
+
+        """
+        store = FakeCalendarStore()
+        for email, events in sorted(workload.events.items()):
+            store.add_calendar(email, events=events)
+        store.add_calendar(
+            appointment_calendar_id, appointment_calendar_name,
+            workload.booked)
+        return store
+
+
+class FakeCalendarServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, latency=0.0, page_size=max_page_size,
+                 error_rate=0.0, quota=None):
+        """A fake calendar API server.
+
+        :param store: The FakeCalendarStore to serve.
+        :param latency: Seconds to wait before answering each request.
+        :param page_size: Largest number of events to return in a page.
+        :param error_rate: Fraction of API calls to refuse with a rate limit
+        error (403 or 429).
+        :param quota: Number of API calls allowed per second, beyond which
+        calls are refused with a 403 userRateLimitExceeded error.
+
+        """
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, FakeCalendarRequestHandler)
+        self.store = store
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.quota = quota
+        self._quota_bucket = (
+            TokenBucket(quota) if quota is not None else None)
+        self.requests = 0
+        self.api_calls = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def throttled(self):
+        """Decide whether an API call should be refused.
+
+        Returns None, or the (status, body) of the error to refuse it with.
+
+        """
+        with self._lock:
+            self.api_calls += 1
+        bucket = self._quota_bucket
+        if bucket is not None and not bucket.try_acquire():
+            error = (403, error_body(
+                403, "userRateLimitExceeded", "User Rate Limit Exceeded"))
+        elif random.random() < self.error_rate:
+            error = random.choice([
+                (403, error_body(
+                    403, "rateLimitExceeded", "Rate Limit Exceeded")),
+                (429, error_body(
+                    429, "rateLimitExceeded", "Too Many Requests")),
+            ])
+        else:
+            return None
+        with self._lock:
+            self.errors += 1
+        return error
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "api_calls": self.api_calls,
+                "errors": self.errors,
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+class FakeCalendarRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET", "")
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        self.handle_request("POST", self.rfile.read(length))
+
+    def handle_request(self, method, body):
+        with self.server._lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = urlparse.urlsplit(self.path).path
+        if method == "POST" and path == "/batch/calendar/v3":
+            self.send_batch(body)
+            return
+        status, result = self.dispatch(method, self.path, body)
+        if status == 304:
+            self.send_not_modified()
+            return
+        self.send_json(status, result)
+
+    def send_not_modified(self):
+        self.send_response(304)
+        self.end_headers()
+
+    def send_json(self, status, result):
+        self.send_content(
+            status, "application/json; charset=UTF-8", json.dumps(result))
+
+    def send_content(self, status, content_type, content):
+        if (
+            "gzip" in self.headers.getheader("accept-encoding", "") and
+            "gzip" in self.headers.getheader("user-agent", "")
+        ):
+            compressed = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as fobj:
+                fobj.write(content)
+            content = compressed.getvalue()
+            encoding = "gzip"
+        else:
+            encoding = None
+        self.count_bytes(content)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def count_bytes(self, content):
+        with self.server._lock:
+            self.server.bytes_sent += len(content)
+
+    def dispatch(self, method, uri, body):
+        """Handle a single API request.  Returns (status, response data)."""
+        parts = urlparse.urlsplit(uri)
+        path = [urllib.unquote(part) for part in parts.path.split("/")[1:]]
+        query = dict(urlparse.parse_qsl(parts.query))
+        status, result = self.call(method, path, query, body)
+        if status == 200 and "fields" in query:
+            result = select_fields(result, parse_fields(query["fields"]))
+        return status, result
+
+    def call(self, method, path, query, body):
+
+        if path == ["discovery", "v1", "apis", "calendar", "v3", "rest"]:
+            return 200, discovery_document(self.server.base_url + "/")
+        if "/" + "/".join(path) == bank_holidays_path:
+            # Synthetic workloads have no bank holidays.
+            return 200, {"division": "england-and-wales", "events": []}
+
+        if path[:2] != ["calendar", "v3"]:
+            return 404, error_body(404, "notFound", "Not Found")
+        error = self.server.throttled()
+        if error is not None:
+            return error
+
+        if method == "GET" and path[2:] == ["users", "me", "calendarList"]:
+            return self.list_calendars(query)
+        if len(path) == 5 and path[2] == "calendars" and path[4] == "events":
+            calendar_id = path[3]
+            if calendar_id not in self.server.store.calendars:
+                return 404, error_body(404, "notFound", "Not Found")
+            if method == "GET":
+                return self.list_events(calendar_id, query)
+            if method == "POST":
+                created = self.server.store.insert(
+                    calendar_id, json.loads(body), replace=False)
+                if created is None:
+                    return 409, error_body(
+                        409, "duplicate",
+                        "The requested identifier already exists.")
+                return 200, created
+        return 404, error_body(404, "notFound", "Not Found")
+
+    def page(self, items, query):
+        """Return a page of items, and the token for the next page."""
+        page_size = min(
+            int(query.get("maxResults", default_page_size)),
+            max_page_size,
+            self.server.page_size,
+        )
+        offset = int(query.get("pageToken", 0))
+        next_offset = offset + page_size
+        if next_offset >= len(items):
+            return items[offset:], None
+        return items[offset:next_offset], str(next_offset)
+
+    def not_modified(self, etag, query):
+        """Return True if the first page of a list was asked for, with an
+        If-None-Match header matching its ETag.
+
+        """
+        return (
+            "pageToken" not in query and
+            self.headers.getheader("if-none-match") == etag
+        )
+
+    def list_calendars(self, query):
+        etag = self.server.store.calendar_list_etag()
+        if self.not_modified(etag, query):
+            return 304, None
+        items = [
+            {"kind": "calendar#calendarListEntry", "id": calendar_id,
+             "summary": summary}
+            for calendar_id, summary in sorted(
+                self.server.store.summaries.items())
+        ]
+        items, next_page_token = self.page(items, query)
+        result = {
+            "kind": "calendar#calendarList",
+            "etag": etag,
+            "items": items,
+        }
+        if next_page_token is not None:
+            result["nextPageToken"] = next_page_token
+        return 200, result
+
+    def list_events(self, calendar_id, query):
+        store = self.server.store
+        etag = store.etag(calendar_id)
+        if self.not_modified(etag, query):
+            return 304, None
+        if "syncToken" in query:
+            try:
+                since = int(query["syncToken"])
+            except ValueError:
+                return 410, error_body(
+                    410, "fullSyncRequired", "Sync token is no longer valid")
+            events, sequence = store.events(calendar_id, since=since)
+        else:
+            events, sequence = store.events(
+                calendar_id,
+                time_min=Event.parse_iso_datetime(
+                    query["timeMin"], is_start=True)
+                if "timeMin" in query else None,
+                time_max=Event.parse_iso_datetime(
+                    query["timeMax"], is_start=False)
+                if "timeMax" in query else None,
+                show_deleted=query.get("showDeleted") == "true",
+            )
+        items, next_page_token = self.page(events, query)
+        result = {"kind": "calendar#events", "etag": etag, "items": items}
+        if next_page_token is None:
+            result["nextSyncToken"] = str(sequence)
+        else:
+            result["nextPageToken"] = next_page_token
+        return 200, result
+
+    def send_batch(self, body):
+        """Handle a multipart/mixed batch request."""
+        message = email.parser.Parser().parsestr(
+            "Content-Type: {}\r\n\r\n{}".format(
+                self.headers.getheader("content-type"), body))
+        boundary = "batch_fake_calendar_server"
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload()
+            request_line, rest = request.split("\n", 1)
+            method, uri = request_line.strip().split(" ")[:2]
+            separator = "\r\n\r\n" if "\r\n\r\n" in rest else "\n\n"
+            request_body = ""
+            if separator in rest:
+                request_body = rest.split(separator, 1)[1]
+            status, result = self.dispatch(method, uri, request_body)
+            content = json.dumps(result)
+            parts.append(
+                "--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                "Content-ID: <response-{content_id}>\r\n"
+                "\r\n"
+                "HTTP/1.1 {status} {reason}\r\n"
+                "Content-Type: application/json; charset=UTF-8\r\n"
+                "Content-Length: {length}\r\n"
+                "\r\n"
+                "{content}\r\n".format(
+                    boundary=boundary,
+                    content_id=part["Content-ID"].strip("<>"),
+                    status=status,
+                    reason=self.responses.get(status, ("",))[0],
+                    length=len(content),
+                    content=content,
+                )
+            )
+        content = "".join(parts) + "--{}--\r\n".format(boundary)
+        self.send_content(
+            200, "multipart/mixed; boundary={}".format(boundary), content)
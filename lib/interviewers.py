@@ -6,13 +6,28 @@ import csv
 import datetime
 import os
 from collections import Counter
-from calendar_fetcher import CalendarCache
+from calendar_caches import cache_formats
+from slot_window import SlotWindowCalendarCache
 
 
 # Count an interview which happens as this many times as much work as just
 # reserving the slot.
 work_of_interview = 3
 
+# Bits in Interviewer.attributes
+CHAIR = 1
+TECHNICAL = 2
+FRONTEND = 4
+CIVIL_SERVANT = 8
+WOMAN = 16
+MAN = 32
+BAME = 64
+NON_BAME = 128
+
+attribute_bits = (
+    CHAIR, TECHNICAL, FRONTEND, CIVIL_SERVANT, WOMAN, MAN, BAME, NON_BAME,
+)
+
 
 def to_bool(value):
     return value.lower().strip().startswith("y")
@@ -32,6 +47,7 @@ class Interviewer(object):
         self.use_rate = float(fields.get("use_rate", "1"))
         self.use_freq = float(fields.get("use_freq", "2"))
         self.team = fields.get("team")
+        self.attributes = self._attributes()
         self.calendar = None
         self.recent_interview_slots = 0
         self.recent_interviews = 0
@@ -40,6 +56,22 @@ class Interviewer(object):
         self.new_slots_by_isoweek = Counter()
         self.possible_slots = {}
 
+    def _attributes(self):
+        attributes = 0
+        for bit, value in (
+            (CHAIR, self.can_chair),
+            (TECHNICAL, self.technical),
+            (FRONTEND, self.can_do_frontend_test),
+            (CIVIL_SERVANT, self.civil_servant),
+            (WOMAN, self.gender == 'f'),
+            (MAN, self.gender == 'm'),
+            (BAME, self.bame == 'y'),
+            (NON_BAME, self.bame == 'n'),
+        ):
+            if value:
+                attributes |= bit
+        return attributes
+
     def add_to_possible(self, conflict_level, start_time):
         self.possible_slots.setdefault(
             conflict_level, set()
@@ -96,19 +128,39 @@ class Interviewers(object):
         return self._people[email]
 
 
-def fetch_interviewers(calendar_service, cache_dir):
+def fetch_interviewers(calendar_service, cache_dir, workers=1, today=None,
+                       resync=False, memory=None, cache_format="json",
+                       fetch_strategy="full", slots=None):
+    """Load the interviewers, with their calendars.
+
+    :param fetch_strategy: "full" to fetch and cache whole calendars, or
+    "slots" to fetch only the events in the window of time covering the new
+    slots, which must be given in `slots`.
+
+    """
     csv_file = os.environ["INTERVIEWERS_CSV"]
 
     interviewers = Interviewers.from_csv(csv_file)
 
-    today = datetime.date.today()
+    if today is None:
+        today = datetime.date.today()
     date_min = today - datetime.timedelta(days=28)
     date_max = today + datetime.timedelta(days=28)
 
-    calendar_fetcher = CalendarCache(
-        calendar_service, date_min, date_max, os.path.join(cache_dir, "calendars")
-    )
+    if fetch_strategy == "slots":
+        # Only new slots need conflict levels.
+        calendar_fetcher = SlotWindowCalendarCache(
+            calendar_service, date_min, date_max, os.path.join(cache_dir, "calendars"),
+            [slot for slot in slots if slot.new],
+            resync=resync, memory=memory,
+        )
+    else:
+        calendar_fetcher = cache_formats[cache_format](
+            calendar_service, date_min, date_max, os.path.join(cache_dir, "calendars"),
+            resync=resync, memory=memory,
+        )
 
+    calendars = calendar_fetcher.get_many(interviewers.emails(), workers)
     for interviewer in interviewers:
-        interviewer.calendar = calendar_fetcher.get(interviewer.email)
+        interviewer.calendar = calendars[interviewer.email]
     return interviewers
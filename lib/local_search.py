@@ -0,0 +1,269 @@
+"""Improve an allocation by making small changes to it.
+
+After an allocator has run, LocalSearch repeatedly tries:
+
+ - rescuing slots which were dropped, by giving them the cheapest viable
+   panel of people who are still free at that time
+ - replacing someone on a panel with a person who isn't on it
+ - swapping two people between panels
+
+and keeps any change which fills a dropped slot, or which lowers the total
+conflict cost (plus a penalty for giving people more than their work share),
+while keeping every panel viable and respecting team exclusivity, weekly
+limits and the 23 hour spacing between slots.  Each change is evaluated from
+the handful of people and slots it touches, so many can be tried in a few
+seconds.  It stops when no change helps, or the time budget runs out.
+
+"""
+
+import time
+
+from allocator import Allocator, min_gap_between_slots
+from solver import SlotProblem, over_share_penalty, viable_panel
+
+# Seconds to spend looking for improvements.
+default_time_budget = 5.0
+
+
+class LocalSearch(object):
+    def __init__(self, allocator, time_budget=default_time_budget):
+        """Improve the allocation made by an allocator, after allocate() has
+        been called.
+
+        """
+        self.allocator = allocator
+        self.interviewers = allocator.interviewers
+        self.assignments = allocator.assignments
+        self.time_budget = time_budget
+        self.moves = 0
+        self.rescued = 0
+
+    def improve(self):
+        self.deadline = time.time() + self.time_budget
+        self.work_share = self._work_share()
+        self.busy_times = {}
+        for assignment in self.assignments:
+            for person in assignment.assigned:
+                self.busy_times.setdefault(person.email, set()).add(
+                    assignment.slot.start)
+
+        print
+        print "Improving allocation"
+        cost_before = self.total_cost()
+        improved = True
+        while improved and not self.out_of_time():
+            improved = False
+            if self._rescue_dropped():
+                improved = True
+            if self._replace_people():
+                improved = True
+            if self._swap_people():
+                improved = True
+
+        self.allocator.update_assignment_events()
+        print "Rescued {} slots and made {} changes, reducing cost from {} to {}".format(
+            self.rescued, self.moves, cost_before, self.total_cost())
+
+    def out_of_time(self):
+        return time.time() > self.deadline
+
+    def total_cost(self):
+        return sum(
+            assignment.cost
+            for assignment in self.assignments.new_assignments()
+        )
+
+    def _work_share(self):
+        """Calculate the work share of each person, as it was before any new
+        slots were assigned.
+
+        """
+        planned = dict(
+            (person.email, person.newly_assigned_interviews)
+            for person in self.interviewers
+        )
+        seats = 3 * (
+            len(self.assignments.new_assignments()) +
+            len(self.allocator.dropped)
+        )
+        if seats == 0:
+            return {}
+        for person in self.interviewers:
+            person.newly_assigned_interviews = 0
+        try:
+            return Allocator.calc_work_share(seats, self.interviewers)
+        finally:
+            for person in self.interviewers:
+                person.newly_assigned_interviews = planned[person.email]
+
+    def _over_share(self, person, change):
+        """Return the change in penalty for changing someone's number of new
+        interviews by `change`.
+
+        """
+        share = self.work_share.get(person.email, 0)
+        load = person.newly_assigned_interviews
+        return over_share_penalty * (
+            max(0, load + change - share) - max(0, load - share))
+
+    def _can_join(self, person, assignment, others, leaving=None):
+        """Check if someone can join a panel with some other people.
+
+        :param leaving: The start time of a slot which the person is leaving
+        at the same time.
+
+        """
+        if person.team in [other.team for other in others]:
+            return False
+        if not viable_panel(others + [person]):
+            return False
+        return self._is_free(person, assignment, leaving)
+
+    def _is_free(self, person, assignment, leaving=None):
+        """Check if someone is under their weekly limit, and not in another
+        slot within 23 hours, for a slot.
+
+        """
+        start = assignment.slot.start
+        week = assignment.slot.isoweek
+        slots_in_week = person.slots_in_week(week)
+        if leaving is not None and leaving.isocalendar()[1] == week:
+            slots_in_week -= 1
+        if slots_in_week >= person.use_freq:
+            return False
+        for busy in self.busy_times.get(person.email, ()):
+            if busy != leaving and abs(busy - start) < min_gap_between_slots:
+                return False
+        return True
+
+    def _add(self, assignment, person):
+        assignment.assign(person.email)
+        self.busy_times.setdefault(person.email, set()).add(
+            assignment.slot.start)
+
+    def _remove(self, assignment, person):
+        assignment.unassign(person.email)
+        self.busy_times[person.email].remove(assignment.slot.start)
+
+    def _rescue_dropped(self):
+        rescued = False
+        for assignment in list(self.allocator.dropped):
+            if self.out_of_time():
+                break
+            for person in assignment.assigned:
+                assignment.unassign(person.email)
+            problem = SlotProblem(assignment, self.interviewers)
+            panels = [
+                (cost + sum(self._over_share(person, 1) for person in added),
+                 added)
+                for cost, added in problem.panels
+                if all(self._is_free(person, assignment) for person in added)
+            ]
+            if not panels:
+                continue
+            added = min(panels, key=lambda panel: panel[0])[1]
+            self.assignments.add(assignment)
+            for person in added:
+                self._add(assignment, person)
+            self.allocator.dropped.remove(assignment)
+            self.rescued += 1
+            rescued = True
+            print " Rescued slot {} with {}".format(
+                assignment.slot.start,
+                ", ".join(person.email for person in added),
+            )
+        return rescued
+
+    def _replace_people(self):
+        improved = False
+        for assignment in self.assignments.new_assignments():
+            if self.out_of_time():
+                break
+            for person in assignment.assigned:
+                if self._replace(assignment, person):
+                    improved = True
+        return improved
+
+    def _replace(self, assignment, person):
+        costs = assignment.costs
+        assigned = assignment.assigned
+        others = [other for other in assigned if other is not person]
+        emails = set(other.email for other in assigned)
+        current = costs.get(person.email, 0)
+        best = None
+        for email, level in costs.items():
+            if email in emails:
+                continue
+            try:
+                candidate = self.interviewers.by_email(email)
+            except KeyError:
+                continue
+            delta = (
+                level - current +
+                self._over_share(candidate, 1) +
+                self._over_share(person, -1)
+            )
+            if delta >= 0 or (best is not None and delta >= best[0]):
+                continue
+            if self._can_join(candidate, assignment, others):
+                best = (delta, candidate)
+        if best is None:
+            return False
+        candidate = best[1]
+        print " Replacing {} with {} in slot {}".format(
+            person.email, candidate.email, assignment.slot.start)
+        self._remove(assignment, person)
+        self._add(assignment, candidate)
+        self.moves += 1
+        return True
+
+    def _swap_people(self):
+        improved = False
+        assignments = list(self.assignments.new_assignments())
+        for index, first in enumerate(assignments):
+            if self.out_of_time():
+                break
+            for second in assignments[index + 1:]:
+                for person in first.assigned:
+                    for other in second.assigned:
+                        if self._swap(first, person, second, other):
+                            improved = True
+                            break
+        return improved
+
+    def _swap(self, first, person, second, other):
+        """Swap person, in the first slot, with other, in the second slot, if
+        that lowers the cost.
+
+        """
+        if (
+            person.email not in second.costs or
+            other.email not in first.costs or
+            person in second.assigned or
+            other in first.assigned
+        ):
+            return False
+        delta = (
+            first.costs[other.email] + second.costs[person.email] -
+            first.costs.get(person.email, 0) -
+            second.costs.get(other.email, 0)
+        )
+        if delta >= 0:
+            return False
+        first_others = [
+            member for member in first.assigned if member is not person]
+        second_others = [
+            member for member in second.assigned if member is not other]
+        if not (
+            self._can_join(other, first, first_others, second.slot.start) and
+            self._can_join(person, second, second_others, first.slot.start)
+        ):
+            return False
+        print " Swapping {} in slot {} with {} in slot {}".format(
+            person.email, first.slot.start, other.email, second.slot.start)
+        self._remove(first, person)
+        self._remove(second, other)
+        self._add(first, other)
+        self._add(second, person)
+        self.moves += 1
+        return True
@@ -0,0 +1,269 @@
+"""Limit the rate of requests made to google APIs.
+
+"""
+
+import json
+import random
+import threading
+import time
+
+# Reasons given by google with a 403 status when a request was refused because
+# of rate limits, rather than because it wasn't allowed.
+rate_limit_reasons = ("rateLimitExceeded", "userRateLimitExceeded")
+
+# Number of times to try a request before giving up.
+max_attempts = 6
+
+# Longest time to wait before retrying a request, in seconds, apart from the
+# random jitter.
+max_backoff = 32
+
+# Most requests to have in progress at once.  Fewer are only made when fewer
+# threads are making requests, or when google starts refusing them.
+max_concurrent_requests = 32
+
+
+def error_reason(error):
+    """Return the reason given in the body of an HttpError, if any."""
+    try:
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def is_not_modified(error):
+    """Return True if a conditional request failed because nothing has
+    changed.
+
+    """
+    resp = getattr(error, "resp", None)
+    return resp is not None and resp.status == 304
+
+
+def is_duplicate(error):
+    """Return True if creating something failed because something with the
+    same id already exists.
+
+    """
+    resp = getattr(error, "resp", None)
+    return resp is not None and resp.status == 409
+
+
+def is_rate_limited(error):
+    """Return True if a request failed because of a rate limit."""
+    resp = getattr(error, "resp", None)
+    if resp is None:
+        return False
+    if resp.status == 403:
+        return error_reason(error) in rate_limit_reasons
+    return resp.status == 429
+
+
+def is_retryable(error):
+    """Return True if a request which failed with an error may succeed if
+    retried later.
+
+    """
+    resp = getattr(error, "resp", None)
+    if resp is None:
+        return False
+    return is_rate_limited(error) or resp.status >= 500
+
+
+def backoff_delay(attempt):
+    """Return the seconds to wait before retrying a request which has failed
+    `attempt` times: exponential backoff, with up to a second of random
+    jitter so that requests which failed together aren't retried together.
+
+    """
+    return min(2 ** (attempt - 1), max_backoff) + random.random()
+
+
+class TokenBucket(object):
+    """A token bucket rate limiter, which may be shared between threads.
+
+    Allows bursts of up to `burst` requests, and an average of `rate`
+    requests per second.
+
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1.0, self.rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Wait until `count` requests are allowed, and use up tokens for
+        them.
+
+        """
+        for _ in range(count):
+            self._acquire_one()
+
+    def try_acquire(self):
+        """Use up a token if one is available, without waiting.
+
+        Returns True if a token was used.
+
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def _acquire_one(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated) * self.rate,
+        )
+        self._updated = now
+
+
+class Unlimited(object):
+    """A rate limiter which doesn't limit anything."""
+
+    def acquire(self, count=1):
+        pass
+
+
+class AdaptiveConcurrency(object):
+    """A limit on the number of requests in progress at once, which may be
+    shared between threads.
+
+    The limit is adjusted in the same way as TCP's congestion window: it
+    grows by one for each `limit` requests which succeed while the limit is
+    reached, up to `maximum`, and is set to half the number of requests in
+    progress when one is refused by a rate limit.  Refusals of requests
+    which started before the last time the limit was lowered don't lower it
+    again, since they were caused by the same burst.
+
+    """
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(maximum)
+        self.in_progress = 0
+        self._started = 0
+        self._decreased_at = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until another request may start.
+
+        Returns a ticket to pass to release() when the request finishes.
+
+        """
+        with self._condition:
+            while self.in_progress >= int(self.limit):
+                self._condition.wait()
+            self.in_progress += 1
+            self._started += 1
+            return self._started
+
+    def release(self, ticket, throttled=False):
+        """Record that a request has finished.
+
+        :param throttled: True if the request was refused by a rate limit.
+
+        """
+        with self._condition:
+            if throttled:
+                self._decrease(ticket, self.in_progress)
+            elif self.in_progress >= int(self.limit):
+                self.limit = min(
+                    float(self.maximum), self.limit + 1.0 / self.limit)
+            self.in_progress -= 1
+            self._condition.notify_all()
+
+    def throttled(self):
+        """Record that part of a batch request was refused by a rate limit,
+        after the batch itself has finished.
+
+        """
+        with self._condition:
+            # The batch is no longer counted as in progress.
+            self._decrease(self._started, self.in_progress + 1)
+
+    def _decrease(self, ticket, in_progress):
+        if ticket > self._decreased_at:
+            self.limit = max(
+                float(self.minimum), min(self.limit, in_progress) / 2.0)
+            self._decreased_at = self._started
+
+
+class RequestExecutor(object):
+    def __init__(self, rate_limiter, traffic,
+                 max_concurrency=max_concurrent_requests):
+        """Executes API requests, which may be shared between threads.
+
+        Requests wait for the rate limiter and for the concurrency limit,
+        and are retried with exponential backoff if they fail with an error
+        which may be temporary.
+
+        :param rate_limiter: Limit on the rate of requests.
+        :param traffic: A TrafficCounter to count API calls and retries in.
+
+        """
+        self.rate_limiter = rate_limiter
+        self.traffic = traffic
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+
+    def execute(self, request, cost=1):
+        """Execute an API request, retrying it until it succeeds, fails with
+        an error which isn't temporary, or has been tried max_attempts
+        times.  Answers of "not modified" to conditional requests are raised
+        as errors, but aren't counted as failures.
+
+        `cost` is the number of requests to count against the rate limit, for
+        batch requests.
+
+        """
+        attempt = 0
+        while True:
+            ticket = self.concurrency.acquire()
+            self.rate_limiter.acquire(cost)
+            self.traffic.count_api_calls(cost)
+            try:
+                result = request.execute()
+            except Exception as error:
+                if is_not_modified(error):
+                    self.concurrency.release(ticket)
+                    self.traffic.count_not_modified()
+                    raise
+                throttled = is_rate_limited(error)
+                self.concurrency.release(ticket, throttled)
+                self.traffic.count_error(throttled)
+                attempt += 1
+                if not is_retryable(error) or attempt >= max_attempts:
+                    raise
+            else:
+                self.concurrency.release(ticket)
+                return result
+            self.traffic.count_retry()
+            time.sleep(backoff_delay(attempt))
+
+    def record_failure(self, error):
+        """Record that part of a batch request failed, after the batch
+        itself has finished.
+
+        """
+        throttled = is_rate_limited(error)
+        if throttled:
+            self.concurrency.throttled()
+        self.traffic.count_error(throttled)
@@ -0,0 +1,317 @@
+"""Serve rotas and coverage questions from a long running process.
+
+RotaService keeps the parsed calendars, and the conflict levels from the last
+allocation, in memory, so proposing a rota or asking who can cover a slot
+doesn't need to authenticate, fetch or parse anything again.  Calendars are
+synced with google in the background.
+
+RotaServer exposes it as a local HTTP API returning JSON:
+
+ - GET /status: when calendars were last refreshed, how many are held, and
+   the requests made to google so far
+ - GET /rota: the last proposed rota (proposing one if there isn't one yet)
+ - POST /propose: propose a rota, re-reading the roster CSV.  Panels from
+   the last proposal are kept where they still work, unless ?fresh=1 is
+   given.
+ - GET /coverage?start=<ISO time>: who is free for a slot, cheapest first.
+   Give the time in UTC with a "Z", or URL-encode any "+".
+ - POST /refresh: sync calendars with google now
+
+"""
+
+import BaseHTTPServer
+import datetime
+import json
+import SocketServer
+import threading
+import time
+import traceback
+import urlparse
+
+from allocation_state import AllocationState
+from allocator import Allocator, SlotAssignment, SlotAssignments
+from calendar_fetcher import Event
+from interviewers import fetch_interviewers
+from slot_generator import fetch_slots
+from solver import OptimalAllocator, default_time_budget
+
+# Seconds between background syncs of the calendars.
+default_refresh_interval = 300
+
+
+def person_json(person):
+    return {"email": person.email, "name": person.name, "team": person.team}
+
+
+class RotaService(object):
+    def __init__(self, calendar_service, cache_dir, workers=8,
+                 engine="greedy", time_budget=default_time_budget,
+                 days_back=28, days_forward=28, minimum_warning=7,
+                 cache_format="json", fetch_strategy="full"):
+        self.calendar_service = calendar_service
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.engine = engine
+        self.time_budget = time_budget
+        self.days_back = days_back
+        self.days_forward = days_forward
+        self.minimum_warning = minimum_warning
+        self.cache_format = cache_format
+        self.fetch_strategy = fetch_strategy
+
+        # Parsed calendars, shared by every load.
+        self.memory = {}
+        self.state = AllocationState()
+        self.rota = None
+        self.refreshed = None
+        self._lock = threading.Lock()
+
+    def _load(self, resync=False):
+        """Return new Slot and Interviewer objects, using the calendars in
+        memory unless resyncing.
+
+        New objects are needed for each allocation, since allocating records
+        its progress in them.
+
+        """
+        today = None
+        if self.calendar_service.snapshot is not None:
+            today = self.calendar_service.snapshot.today
+        slots = fetch_slots(
+            self.calendar_service,
+            self.cache_dir,
+            days_back = self.days_back,
+            days_forward = self.days_forward,
+            minimum_warning = self.minimum_warning,
+            today = today,
+            resync = resync,
+            memory = self.memory,
+            cache_format = self.cache_format,
+        )
+        interviewers = fetch_interviewers(
+            self.calendar_service,
+            self.cache_dir,
+            workers = self.workers,
+            today = today,
+            resync = resync,
+            memory = self.memory,
+            cache_format = self.cache_format,
+            fetch_strategy = self.fetch_strategy,
+            slots = slots,
+        )
+        return slots, interviewers
+
+    def refresh(self):
+        """Sync the calendars with google."""
+        with self._lock:
+            self._load(resync=True)
+            self.refreshed = datetime.datetime.utcnow()
+
+    def status(self):
+        with self._lock:
+            return {
+                "refreshed": (
+                    self.refreshed.isoformat() + "Z"
+                    if self.refreshed is not None else None
+                ),
+                "calendars": len(self.memory),
+                "traffic": self.calendar_service.traffic.stats(),
+                "proposed": self.rota["proposed"] if self.rota else None,
+            }
+
+    def get_rota(self):
+        with self._lock:
+            rota = self.rota
+        if rota is None:
+            rota = self.propose()
+        return rota
+
+    def propose(self, fresh=False):
+        """Propose a rota, re-reading the roster."""
+        with self._lock:
+            if fresh:
+                self.state = AllocationState()
+            slots, interviewers = self._load()
+            assignments = SlotAssignments(
+                SlotAssignment(slot, interviewers)
+                for slot in slots
+            )
+            if self.engine == "optimal":
+                allocator = OptimalAllocator(
+                    slots, interviewers, assignments, self.time_budget,
+                    self.state)
+            else:
+                allocator = Allocator(
+                    slots, interviewers, assignments, self.state)
+            allocator.allocate()
+            self.state.update(allocator)
+
+            self.rota = {
+                "proposed": datetime.datetime.utcnow().isoformat() + "Z",
+                "slots": [
+                    {
+                        "start": assignment.slot.start.isoformat(),
+                        "end": assignment.slot.end.isoformat(),
+                        "viable": assignment.viable,
+                        "cost": assignment.cost,
+                        "people": [
+                            person_json(person)
+                            for person in assignment.assigned
+                        ],
+                    }
+                    for assignment in assignments.new_assignments()
+                ],
+                "unfilled": sorted(
+                    assignment.slot.start.isoformat()
+                    for assignment in allocator.dropped
+                ),
+            }
+            return self.rota
+
+    def coverage(self, start):
+        """Return who is free for the slot starting at a time, cheapest
+        first, or None if there is no such slot.
+
+        Each person's slots in the week include the other slots they are
+        proposed for in the last rota.
+
+        """
+        with self._lock:
+            slots, interviewers = self._load()
+            rota = self.rota
+        matching = [slot for slot in slots if slot.start == start]
+        if not matching:
+            return None
+        slot = matching[0]
+
+        Allocator(slots, interviewers, None).count_recent_interviews()
+        slots_by_start = dict(
+            (other.start.isoformat(), other) for other in slots)
+        proposed = set()
+        for entry in (rota or {}).get("slots", ()):
+            emails = [person["email"] for person in entry["people"]]
+            if entry["start"] == slot.start.isoformat():
+                proposed = set(emails)
+                continue
+            other = slots_by_start.get(entry["start"])
+            if other is None:
+                continue
+            for email in emails:
+                try:
+                    person = interviewers.by_email(email)
+                except KeyError:
+                    continue
+                person.new_slots_by_isoweek[other.isoweek] += 1
+
+        people = []
+        for person in interviewers:
+            level = person.calendar.conflict_level(slot.start, slot.end)
+            if level is None:
+                continue
+            result = person_json(person)
+            result.update({
+                "conflict_level": level,
+                "can_chair": person.can_chair,
+                "technical": person.technical,
+                "can_do_frontend_test": person.can_do_frontend_test,
+                "civil_servant": person.civil_servant,
+                "slots_in_week": person.slots_in_week(slot.isoweek),
+                "use_freq": person.use_freq,
+                "proposed": person.email in proposed,
+            })
+            people.append(result)
+        people.sort(key=lambda result: (
+            result["conflict_level"], result["email"]))
+        return {
+            "start": slot.start.isoformat(),
+            "end": slot.end.isoformat(),
+            "new": slot.new,
+            "people": people,
+        }
+
+    def start_refreshing(self, interval=default_refresh_interval):
+        """Sync the calendars with google every `interval` seconds, in a
+        background thread.
+
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.refresh()
+                except Exception:
+                    print "Background refresh failed"
+                    traceback.print_exc()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class RotaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, RotaRequestHandler)
+        self.service = service
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+class RotaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        parts = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(parts.query))
+        service = self.server.service
+        try:
+            if method == "GET" and parts.path == "/status":
+                self.send_json(200, service.status())
+            elif method == "GET" and parts.path == "/rota":
+                self.send_json(200, service.get_rota())
+            elif method == "POST" and parts.path == "/propose":
+                self.send_json(200, service.propose(
+                    fresh=query.get("fresh") == "1"))
+            elif method == "POST" and parts.path == "/refresh":
+                service.refresh()
+                self.send_json(200, service.status())
+            elif method == "GET" and parts.path == "/coverage":
+                self.coverage(service, query)
+            else:
+                self.send_json(404, {"error": "Not found"})
+        except Exception as e:
+            traceback.print_exc()
+            self.send_json(500, {"error": str(e)})
+
+    def coverage(self, service, query):
+        if "start" not in query:
+            self.send_json(400, {"error": "start is required"})
+            return
+        try:
+            start = Event.parse_iso_datetime(query["start"], is_start=True)
+        except ValueError:
+            self.send_json(400, {"error": "Invalid start time"})
+            return
+        result = service.coverage(start)
+        if result is None:
+            self.send_json(404, {"error": "No slot starts at that time"})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, result):
+        content = json.dumps(result, indent=2, sort_keys=True)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -1,6 +1,8 @@
-from bank_holidays import BankHolidays
-from calendar_fetcher import CalendarCache, Event
+from bank_holidays import BankHolidays, bank_holidays_path, bank_holidays_url
+from calendar_caches import cache_formats
+from calendar_fetcher import Event
 import datetime
+import hashlib
 import os
 import pytz
 
@@ -35,8 +37,23 @@ class Slot(object):
     def can_do_frontend(self):
         return any(person.can_do_frontend_test for person in self.people())
 
+    def placeholder_event_id(self):
+        """Return the id to create the placeholder event with.
+
+        Made from the slot's start time and panel, so that retrying a
+        request which created the event, but whose response was lost, is
+        refused by google rather than creating it again.  Hex digits are
+        valid in google's base32hex event ids.
+
+        """
+        return hashlib.sha1("{} {}".format(
+            self.event.start.isoformat(),
+            " ".join(sorted(person.email for person in self.people())),
+        )).hexdigest()
+
     def placeholder_invitation(self):
         return {
+            "id": self.placeholder_event_id(),
             "summary": "Interview placeholder - keep free - ({})".format(
                 "front/backend developer"
                 if self.can_do_frontend()
@@ -78,12 +95,14 @@ Also, if you haven't completed at least the unconscious bias e-learning, now's a
 
 
 class SlotGenerator(object):
-    def __init__(self, calendar_fetcher, date_min, min_new_slot_date, date_max, cache_dir):
+    def __init__(self, calendar_fetcher, date_min, min_new_slot_date, date_max, cache_dir,
+                 snapshot=None, holidays_url=bank_holidays_url):
         self.calendar_fetcher = calendar_fetcher
         self.date_min = date_min
         self.min_new_slot_date = min_new_slot_date
         self.date_max = date_max
-        self.bank_holidays = BankHolidays(cache_dir).dates()
+        self.bank_holidays = BankHolidays(
+            cache_dir, snapshot, holidays_url).dates()
 
     def generate(self):
         self.booked = self.calendar_fetcher.get(appointment_calendar_name)
@@ -94,11 +113,10 @@ class SlotGenerator(object):
             yield self.associate_event(Slot(date, "14:15", 150, new))
 
     def associate_event(self, slot):
-        for event in self.booked.events:
+        for event in self.booked.intersecting_events(slot.start, slot.end):
             if not "interview" in event.summary.lower() and not "booked" in event.summary.lower():
                 continue
-            if event.intersects_with(slot.start, slot.end):
-                slot.event = event
+            slot.event = event
 
         if slot.new:
             if slot.event is None:
@@ -107,7 +125,8 @@ class SlotGenerator(object):
                 slot.new = False
         return slot
 
-    def make_placeholder_event(self, slot):
+    @staticmethod
+    def make_placeholder_event(slot):
         event = Event({
             "start": {"dateTime": slot.start.isoformat()},
             "end": {"dateTime": slot.end.isoformat()},
@@ -129,17 +148,28 @@ class SlotGenerator(object):
 
 
 def fetch_slots(calendar_service, cache_dir, days_back, days_forward,
-                minimum_warning):
-    today = datetime.date.today()
+                minimum_warning, today=None, resync=False, memory=None,
+                cache_format="json"):
+    if today is None:
+        today = datetime.date.today()
     date_min = today - datetime.timedelta(days=days_back)
     date_max = today + datetime.timedelta(days=days_forward)
     min_new_slot_date = today + datetime.timedelta(days=minimum_warning)
 
-    calendar_fetcher = CalendarCache(
-        calendar_service, date_min, date_max, os.path.join(cache_dir, "calendars")
+    holidays_url = bank_holidays_url
+    if calendar_service.base_url is not None:
+        # A server standing in for google stands in for gov.uk too.
+        holidays_url = (
+            calendar_service.base_url.rstrip("/") + bank_holidays_path)
+
+    calendar_fetcher = cache_formats[cache_format](
+        calendar_service, date_min, date_max, os.path.join(cache_dir, "calendars"),
+        resync=resync, memory=memory,
     )
 
     return list(SlotGenerator(
         calendar_fetcher, date_min, min_new_slot_date, date_max,
         os.path.join(cache_dir, "slots"),
+        calendar_service.snapshot,
+        holidays_url,
     ).generate())
@@ -0,0 +1,64 @@
+"""Fetch only the parts of interviewers' calendars which overlap new slots.
+
+A full fetch downloads every event in every interviewer's calendar, from four
+weeks back to eight weeks ahead, although conflict levels are only needed for
+the new slots, which start a week ahead.  SlotWindowCalendarCache instead
+fetches each calendar's events only from the start of the first new slot to
+the end of the last one, with one list of events per calendar.
+
+All the events in that window are fetched, including those marked as free,
+such as most "out of office" and "preferred interview slot" events, so the
+conflict levels are the same as with a full fetch.  Nothing is cached between
+runs, since changes can't be synced for part of a calendar, so the full fetch
+is cheaper for repeated runs.
+
+"""
+
+from calendar_fetcher import Calendar, CalendarCache, Event, events_fingerprint
+
+
+def format_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class SlotWindowCalendarCache(CalendarCache):
+    def __init__(self, calendar_service, date_min, date_max, cache_dir, slots,
+                 classifier=None, resync=False, memory=None):
+        """Fetch calendars for the window of time covering some slots.
+
+        :param slots: The slots which conflict levels are needed for.
+
+        """
+        super(SlotWindowCalendarCache, self).__init__(
+            calendar_service, date_min, date_max, cache_dir,
+            classifier=classifier, resync=resync, memory=memory,
+        )
+        self.slots = sorted(slots, key=lambda slot: slot.start)
+
+    def _load_calendar(self, calendar_summary, calendar_fetcher,
+                       remembered=None):
+        data = []
+        if self.slots:
+            data = calendar_fetcher.fetch_events_between(
+                calendar_summary,
+                format_time(self.slots[0].start),
+                format_time(max(slot.end for slot in self.slots)),
+            )
+        fingerprint = events_fingerprint(data)
+        if (
+            remembered is not None and
+            remembered.fingerprint == fingerprint
+        ):
+            return remembered
+        calendar_id = self.calendar_service.calendar_id(calendar_summary)
+        return Calendar(
+            calendar_summary,
+            [
+                event for event in (
+                    Event(event, True, calendar_id, self.classifier)
+                    for event in data
+                )
+                if event.intersects_with(self.window_start, self.window_end)
+            ],
+            fingerprint,
+        )
@@ -0,0 +1,167 @@
+"""Record and replay the responses from google.
+
+A snapshot holds the responses to every GET request made while recording:
+the API discovery document, the pages of the calendar list and of events, and
+the bank holidays.  Replaying a snapshot serves the same requests from it
+without touching the network, so a run can be repeated exactly, later and
+elsewhere.
+
+Other requests aren't recorded.  The only ones made are the batch requests
+which create events, and nothing is created when replaying.
+
+"""
+
+import datetime
+import gzip
+import json
+import os
+import threading
+import urllib
+import urlparse
+
+# Version of the snapshot file format.
+snapshot_version = 1
+
+# Query parameters which aren't part of the key a request is stored under.
+ignored_parameters = ("fields", "maxResults")
+
+
+class SnapshotError(Exception):
+    """A request couldn't be served from a snapshot."""
+
+
+def request_key(method, uri):
+    """Return the key a request is stored under in a snapshot.
+
+    The query parameters are put in a consistent order, so that requests are
+    found however their parameters were ordered.  Parameters which only
+    change how much of a response is sent are left out, so that snapshots
+    recorded with different page sizes or partial response fields still
+    replay.  The server's host is left out too, so that a snapshot recorded
+    from one server (such as a fake calendar API) replays with any other.
+
+    """
+    parts = urlparse.urlsplit(uri)
+    query = sorted(
+        (name, value)
+        for name, value in urlparse.parse_qsl(
+            parts.query, keep_blank_values=True)
+        if name not in ignored_parameters
+    )
+    return "{} {}?{}".format(method, parts.path, urllib.urlencode(query))
+
+
+def open_file(path, mode, gzipped):
+    if gzipped:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class Snapshot(object):
+    def __init__(self, today, replaying=False, responses=None):
+        """A set of recorded responses.
+
+        :param today: The date the snapshot was recorded, which a replayed run
+        should treat as today.
+        :param replaying: True if the snapshot is being replayed, False if it
+        is being recorded.
+
+        """
+        self.today = today
+        self.replaying = replaying
+        self.responses = responses if responses is not None else {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def record_new():
+        """Start recording a new snapshot."""
+        return Snapshot(datetime.date.today())
+
+    @staticmethod
+    def load(path):
+        """Load a snapshot to replay.  Files ending in .gz are gzipped."""
+        with open_file(path, "rb", path.endswith(".gz")) as fobj:
+            data = json.load(fobj)
+        if data.get("version") != snapshot_version:
+            raise SnapshotError("Unsupported snapshot version {} in {}".format(
+                data.get("version"), path))
+        today = datetime.datetime.strptime(data["today"], "%Y-%m-%d").date()
+        return Snapshot(today, replaying=True, responses=dict(
+            (key, (response["status"], response["content"].encode("utf8")))
+            for key, response in data["responses"].items()
+        ))
+
+    def save(self, path):
+        with self._lock:
+            responses = dict(
+                (key, {"status": status, "content": content.decode("utf8")})
+                for key, (status, content) in self.responses.items()
+            )
+        with open_file(path + ".tmp", "wb", path.endswith(".gz")) as fobj:
+            json.dump({
+                "version": snapshot_version,
+                "today": self.today.isoformat(),
+                "responses": responses,
+            }, fobj)
+        os.rename(path + ".tmp", path)
+
+    def record(self, method, uri, status, content):
+        with self._lock:
+            self.responses[request_key(method, uri)] = (status, content)
+
+    def lookup(self, method, uri):
+        """Return the (status, content) recorded for a request."""
+        try:
+            return self.responses[request_key(method, uri)]
+        except KeyError:
+            raise SnapshotError("No response recorded for {} {}".format(
+                method, uri))
+
+    def get(self, url, fetch):
+        """Get the content at a URL which isn't fetched with an http object.
+
+        When recording, the content is fetched by calling fetch(url).
+
+        """
+        if self.replaying:
+            return self.lookup("GET", url)[1]
+        content = fetch(url)
+        self.record("GET", url, 200, content)
+        return content
+
+    def wrap_http(self, http):
+        """Make an http object record responses to GET requests, in the same
+        way that oauth2client wraps it to add authorization.
+
+        """
+        request = http.request
+
+        def record_request(uri, method="GET", *args, **kwargs):
+            resp, content = request(uri, method, *args, **kwargs)
+            if method == "GET":
+                self.record(method, uri, resp.status, content)
+            return resp, content
+
+        if hasattr(request, "credentials"):
+            record_request.credentials = request.credentials
+        http.request = record_request
+        return http
+
+
+class ReplayHttp(object):
+    """An http object which serves GET requests from a snapshot."""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def request(self, uri, method="GET", *args, **kwargs):
+        if method != "GET":
+            raise SnapshotError(
+                "Can't make {} requests when replaying a snapshot".format(
+                    method))
+        import httplib2
+        status, content = self.snapshot.lookup(method, uri)
+        return httplib2.Response({
+            "status": status,
+            "content-type": "application/json; charset=UTF-8",
+        }), content
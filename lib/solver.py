@@ -0,0 +1,403 @@
+"""Allocate people to all the new interview slots at once.
+
+The greedy Allocator fills the slots one requirement at a time, and has to
+drop a slot when an earlier pass has left no way of meeting a later
+requirement.  OptimalAllocator instead chooses whole panels for every slot
+together, minimising a single cost:
+
+ - the conflict level of each person for the slot they are given
+ - a penalty for giving anyone more interviews than their work share
+ - a large penalty for each slot which is left without a viable panel
+
+subject to the same rules as the greedy allocator: viable panels, nobody from
+the same team on a panel, nobody in two slots within 23 hours, and nobody
+over their weekly limit of interview slots.
+
+A list of the cheapest viable panels is made for each slot, from a limited
+pool of the cheapest people for it, and the combination of panels is found by
+a branch and bound search, using limited discrepancy search so that good
+solutions are found early.  The search stops when it has proved the best
+solution optimal, or when the time budget runs out, in which case the best
+solution found so far is used.  The time budget covers making the lists of
+panels too.
+
+A solution is only optimal among the panels in those lists, so it is then
+improved by LocalSearch, which can bring in anyone, for whatever is left of
+the time budget.
+
+"""
+
+import itertools
+import time
+from collections import Counter
+
+from allocator import Allocator, min_gap_between_slots
+
+# Seconds to spend searching for better solutions.
+default_time_budget = 10.0
+
+# Cost of leaving a slot unfilled.  Higher than the cost of any panel, so
+# filling more slots always wins.
+unfilled_penalty = 100
+
+# Cost of each interview beyond a person's work share, multiplied by the
+# number of interviews they are over by.
+over_share_penalty = 4
+
+# Reduction in the cost of a panel which can run the frontend test.
+frontend_bonus = 1
+
+# Panels are made from a pool of the cheapest people available for each slot:
+# the cheapest few in each group needed for a viable panel, and then the
+# cheapest of the rest, up to candidates_per_slot people in all.  This bounds
+# the number of panels made for each slot, which grows with the cube of the
+# size of the pool.
+candidates_per_slot = 32
+candidates_per_group = 4
+
+# Share of the time budget kept for improving the solution with LocalSearch.
+improve_share = 0.25
+
+# Number of panels to make, and of nodes to search, between checks of the
+# time budget.
+panels_between_checks = 1000
+nodes_between_checks = 100
+
+# Number of the cheapest panels considered for each slot.
+panels_per_slot = 50
+
+candidate_groups = [
+    lambda person: person.can_chair,
+    lambda person: person.technical,
+    lambda person: person.civil_servant,
+    lambda person: person.can_do_frontend_test,
+    lambda person: person.gender == 'f',
+    lambda person: person.gender == 'm',
+    lambda person: person.bame == 'y',
+    lambda person: person.bame == 'n',
+]
+
+
+class OutOfTime(Exception):
+    pass
+
+
+def viable_panel(people):
+    """Return True if a panel of people is sufficient to run an interview.
+
+    The same rules as SlotAssignment.viable.
+
+    """
+    return (
+        len(people) == 3 and
+        any(person.can_chair for person in people) and
+        len([person for person in people if person.technical]) >= 2 and
+        len(set(person.gender for person in people)) >= 2 and
+        len(set(person.bame for person in people)) >= 2 and
+        len([person for person in people if person.civil_servant]) >= 2
+    )
+
+
+class SlotProblem(object):
+    def __init__(self, assignment, interviewers, deadline=None):
+        """The choice of panel for one slot.
+
+        :param assignment: The SlotAssignment for the slot.  People already
+        assigned to it are kept.
+        :param deadline: A time after which to stop making panels, once some
+        viable ones have been found.
+
+        """
+        self.assignment = assignment
+        self.start = assignment.slot.start
+        self.isoweek = assignment.slot.isoweek
+        self.fixed = list(assignment.assigned)
+        # The people the panels are made from.
+        self.people = []
+        self.panels = self._make_panels(assignment, interviewers, deadline)
+
+    def _make_panels(self, assignment, interviewers, deadline):
+        """Return the cheapest viable panels, as a list of (cost, people to
+        add) sorted by cost.
+
+        """
+        needed = 3 - len(self.fixed)
+        if needed <= 0:
+            return []
+        fixed_emails = set(person.email for person in self.fixed)
+        fixed_teams = set(person.team for person in self.fixed)
+        available = sorted(
+            (cost, email)
+            for email, cost in assignment.costs.items()
+            if email not in fixed_emails
+        )
+        people = []
+        for cost, email in available:
+            try:
+                person = interviewers.by_email(email)
+            except KeyError:
+                continue
+            if person.team not in fixed_teams:
+                people.append(person)
+
+        pool = set()
+        for group in candidate_groups:
+            pool.update(
+                [person for person in people if group(person)]
+                [:candidates_per_group]
+            )
+        for person in people:
+            if len(pool) >= candidates_per_slot:
+                break
+            pool.add(person)
+        pool = sorted(pool, key=lambda person: person.email)
+        self.people = pool
+
+        panels = []
+        for count, added in enumerate(
+                itertools.combinations(pool, needed), 1):
+            if (
+                deadline is not None and panels and
+                count % panels_between_checks == 0 and
+                time.time() > deadline
+            ):
+                break
+            if len(set(person.team for person in added)) < needed:
+                continue
+            panel = self.fixed + list(added)
+            if not viable_panel(panel):
+                continue
+            cost = sum(assignment.costs[person.email] for person in added)
+            if any(person.can_do_frontend_test for person in panel):
+                cost -= frontend_bonus
+            panels.append((cost, added))
+        panels.sort(key=lambda panel: (
+            panel[0], [person.email for person in panel[1]]))
+        return panels[:panels_per_slot]
+
+
+class PanelSolver(object):
+    def __init__(self, problems, work_share, busy_times, deadline):
+        """Choose a panel, or none, for each slot.
+
+        :param problems: The SlotProblem for each slot to fill.
+        :param work_share: The number of interviews to aim to give each
+        person, by email.
+        :param busy_times: The start times of the slots each person is already
+        assigned to, by email.
+        :param deadline: The time at which to stop searching and settle for
+        the best solution found.
+
+        """
+        # Slots with the fewest possible panels are decided first.
+        self.problems = sorted(
+            problems, key=lambda problem: (len(problem.panels), problem.start))
+        self.work_share = work_share
+        self.busy_times = dict(
+            (email, list(times)) for email, times in busy_times.items())
+        self.deadline = deadline
+
+        # Lowest possible cost of the slots from each position onwards.
+        self.remaining_bound = [0] * (len(self.problems) + 1)
+        for index in range(len(self.problems) - 1, -1, -1):
+            panels = self.problems[index].panels
+            cheapest = min(panels[0][0], unfilled_penalty) if panels \
+                else unfilled_penalty
+            self.remaining_bound[index] = (
+                self.remaining_bound[index + 1] + cheapest)
+
+        self.load = Counter()
+        self.week_load = Counter()
+        self.choices = [None] * len(self.problems)
+        self.best_cost = None
+        self.best_choices = None
+        self.nodes = 0
+        self.optimal = False
+
+    def solve(self):
+        """Search for the best choice of panels.
+
+        Returns a dict mapping the start time of each slot to the people to
+        add to it, or None to leave it unfilled.
+
+        """
+        discrepancies = 0
+        try:
+            while True:
+                self.limited = False
+                self._search(discrepancies)
+                if not self.limited:
+                    self.optimal = True
+                    break
+                discrepancies += 1
+        except OutOfTime:
+            pass
+        return dict(
+            (problem.start, choice)
+            for problem, choice in zip(self.problems, self.best_choices)
+        )
+
+    def _search(self, discrepancies):
+        """Search the choices which take the cheapest option for all but up
+        to `discrepancies` slots.
+
+        Each slot being decided has a frame on a stack, of its index, the
+        cost of the choices before it, the discrepancies left, its options
+        and the position of the next option to try, so that there can be any
+        number of slots.
+
+        """
+        stack = []
+        self._enter(stack, 0, 0, discrepancies)
+        while stack:
+            frame = stack[-1]
+            index, cost, discrepancies, options, position = frame
+            if position > 0:
+                self._unchoose(index, options[position - 1][1])
+            if position == len(options):
+                stack.pop()
+                continue
+            option_cost, added = options[position]
+            if self.best_cost is not None and (
+                cost + option_cost + self.remaining_bound[index + 1] >=
+                self.best_cost
+            ):
+                # Options are in cost order, so no later one can do better.
+                stack.pop()
+                continue
+            if position > 0 and discrepancies == 0:
+                self.limited = True
+                stack.pop()
+                continue
+            frame[4] = position + 1
+            self._choose(index, added)
+            self._enter(
+                stack, index + 1, cost + option_cost,
+                discrepancies - (1 if position > 0 else 0),
+            )
+
+    def _enter(self, stack, index, cost, discrepancies):
+        """Visit a node of the search: record a solution if every slot has
+        been decided, or push a frame for deciding the next slot.
+
+        """
+        self.nodes += 1
+        if self.nodes % nodes_between_checks == 0 and \
+                time.time() > self.deadline and \
+                self.best_choices is not None:
+            raise OutOfTime()
+        if index == len(self.problems):
+            if self.best_cost is None or cost < self.best_cost:
+                self.best_cost = cost
+                self.best_choices = list(self.choices)
+            return
+
+        problem = self.problems[index]
+        # The cost of adding each person who is still free for the slot,
+        # beyond their conflict level.
+        extra = {}
+        for person in problem.people:
+            if self._allowed(problem, person):
+                extra[person] = self._over_share_cost(person)
+        options = [
+            (panel_cost + sum(extra[person] for person in added), added)
+            for panel_cost, added in problem.panels
+            if all(person in extra for person in added)
+        ]
+        options.append((unfilled_penalty, None))
+        options.sort(key=lambda option: option[0])
+        stack.append([index, cost, discrepancies, options, 0])
+
+    def _allowed(self, problem, person):
+        if (
+            person.slots_in_week(problem.isoweek) +
+            self.week_load[(person.email, problem.isoweek)] >=
+            person.use_freq
+        ):
+            return False
+        for start in self.busy_times.get(person.email, ()):
+            if abs(start - problem.start) < min_gap_between_slots:
+                return False
+        return True
+
+    def _over_share_cost(self, person):
+        over = self.load[person.email] + 1 - self.work_share.get(
+            person.email, 0)
+        if over > 0:
+            return over_share_penalty * over
+        return 0
+
+    def _choose(self, index, added):
+        problem = self.problems[index]
+        self.choices[index] = added
+        for person in added or ():
+            self.load[person.email] += 1
+            self.week_load[(person.email, problem.isoweek)] += 1
+            self.busy_times.setdefault(person.email, []).append(problem.start)
+
+    def _unchoose(self, index, added):
+        problem = self.problems[index]
+        self.choices[index] = None
+        for person in added or ():
+            self.load[person.email] -= 1
+            self.week_load[(person.email, problem.isoweek)] -= 1
+            self.busy_times[person.email].pop()
+
+
+class OptimalAllocator(Allocator):
+    def __init__(self, slots, interviewers, assignments,
+                 time_budget=default_time_budget, state=None):
+        super(OptimalAllocator, self).__init__(
+            slots, interviewers, assignments, state)
+        self.time_budget = time_budget
+
+    def allocate(self):
+        self.count_recent_interviews()
+        self.conflict_levels = self.calc_conflict_levels(
+            self.interviewers,
+            self.assignments,
+            self.state,
+        )
+        self.warm_start()
+
+        print
+        print "Choosing panels for all slots"
+        deadline = time.time() + self.time_budget
+        problems = []
+        for assignment in self.assignments.new_assignments():
+            problem = SlotProblem(assignment, self.interviewers, deadline)
+            if len(problem.fixed) < 3:
+                problems.append(problem)
+
+        busy_times = {}
+        for assignment in self.assignments:
+            for person in assignment.assigned:
+                busy_times.setdefault(person.email, []).append(
+                    assignment.slot.start)
+
+        work_share = self.calc_work_share(
+            sum(3 - len(problem.fixed) for problem in problems),
+            self.interviewers,
+        )
+        solver = PanelSolver(
+            problems, work_share, busy_times,
+            deadline - self.time_budget * improve_share)
+        solution = solver.solve()
+        print "Searched {} nodes: {} solution with cost {}".format(
+            solver.nodes,
+            "optimal" if solver.optimal else "best found",
+            solver.best_cost,
+        )
+
+        for problem in problems:
+            for person in solution[problem.start] or ():
+                print " Assigning {} to slot {}".format(
+                    person.email, problem.start)
+                self.assignments.assign(problem.start, person.email)
+
+        self.drop_slots(lambda x: not x.viable, "viable panel")
+        self.update_assignment_events()
+
+        # Imported here, as local_search uses the panels made here.
+        from local_search import LocalSearch
+        LocalSearch(self, max(0, deadline - time.time())).improve()
@@ -0,0 +1,300 @@
+"""Generate synthetic interviewers, calendars and slots.
+
+Used to exercise the allocator at realistic (or larger than realistic) scale
+without access to google calendar.  Calendars are generated in the same form
+as the events returned by the calendar API, with recurring meetings, one-off
+meetings, leave and out of office events, and preferred interview slot
+markers.
+
+"""
+
+import csv
+import datetime
+import json
+import os
+import random
+import re
+
+from allocator import SlotAssignment, SlotAssignments
+from calendar_fetcher import Calendar, Event
+from interviewers import Interviewers
+from slot_generator import Slot, SlotGenerator
+
+interviewer_fields = [
+    "name",
+    "email",
+    "can_chair",
+    "technical",
+    "can_do_frontend_test",
+    "senior_developer",
+    "civil_servant",
+    "gender",
+    "bame",
+    "use_rate",
+    "use_freq",
+    "team",
+]
+
+teams = [
+    "GOV.UK", "Verify", "Pay", "Notify", "Platform", "Registers",
+    "Performance Platform", "Digital Marketplace", "Reliability Engineering",
+    "Service Manual", "Data", "Technology Leaders",
+]
+
+meeting_summaries = [
+    "Team meeting", "Planning", "Retro", "Show and tell", "1:1",
+    "Architecture review", "Catch up", "Lunch and learn", "Workshop",
+]
+
+leave_summaries = ["Annual leave", "A/L", "Holiday", "Off"]
+
+out_of_office_summaries = ["OOO", "WFH", "Working from home", "2nd line"]
+
+
+def yes_no(rng, probability):
+    return "yes" if rng.random() < probability else "no"
+
+
+def weekdays(date_min, date_max):
+    date = date_min
+    while date <= date_max:
+        if date.weekday() < 5:
+            yield date
+        date += datetime.timedelta(days=1)
+
+
+def utc_datetime(date, hour, minute):
+    return "{}T{:02d}:{:02d}:00Z".format(date.isoformat(), hour, minute)
+
+
+class SyntheticWorkload(object):
+    def __init__(self, people=150, days=28, days_back=28, events_per_person=500,
+                 minimum_warning=7, seed=0, today=None):
+        """Generate a workload.
+
+        :param people: Number of interviewers.
+        :param days: Number of days ahead to generate slots for.
+        :param days_back: Number of days of past slots and events.
+        :param events_per_person: Approximate number of calendar events for
+        each person, across the whole range.
+        :param minimum_warning: Number of days ahead before slots are new.
+
+        """
+        self.people = people
+        self.days = days
+        self.days_back = days_back
+        self.events_per_person = events_per_person
+        self.rng = random.Random(seed)
+        if today is None:
+            today = datetime.date.today()
+        self.date_min = today - datetime.timedelta(days=days_back)
+        self.date_max = today + datetime.timedelta(days=days)
+        self.min_new_slot_date = today + datetime.timedelta(
+            days=minimum_warning)
+        self.dates = list(weekdays(self.date_min, self.date_max))
+
+        self.rows = [self._interviewer_row(index) for index in range(people)]
+        self.events = dict(
+            (row["email"], self._calendar_events(row["email"]))
+            for row in self.rows
+        )
+        self.booked = self._booked_events()
+
+    def _interviewer_row(self, index):
+        rng = self.rng
+        return {
+            "name": "Person {}".format(index),
+            "email": "person{:04d}@example.com".format(index),
+            "can_chair": yes_no(rng, 0.25),
+            "technical": yes_no(rng, 0.7),
+            "can_do_frontend_test": yes_no(rng, 0.2),
+            "senior_developer": yes_no(rng, 0.4),
+            "civil_servant": yes_no(rng, 0.6),
+            "gender": "f" if rng.random() < 0.4 else "m",
+            "bame": "y" if rng.random() < 0.2 else "n",
+            "use_rate": rng.choice(["1", "1", "1", "0.5"]),
+            "use_freq": rng.choice(["2", "2", "1"]),
+            "team": rng.choice(teams),
+        }
+
+    def _calendar_events(self, email):
+        rng = self.rng
+        events = []
+
+        def add(summary, start, end, attendees=(), transparent=False):
+            event = {
+                "id": "{}_{}".format(len(events), email),
+                "summary": summary,
+                "start": start,
+                "end": end,
+            }
+            if transparent:
+                event["transparency"] = "transparent"
+            if attendees:
+                event["attendees"] = [{
+                    "email": email,
+                    "self": True,
+                    "responseStatus": rng.choice([
+                        "accepted", "accepted", "accepted", "accepted",
+                        "tentative", "declined", "needsAction",
+                    ]),
+                }] + [{
+                    "email": "colleague{}@example.com".format(
+                        rng.randint(0, 999)),
+                    "responseStatus": rng.choice([
+                        "accepted", "accepted", "tentative", "needsAction",
+                    ]),
+                } for _ in range(attendees)]
+            events.append(event)
+
+        # Recurring meetings, expanded into single events as the API returns
+        # them: a daily standup, and some weekly meetings.
+        for date in self.dates:
+            add("Standup", {"dateTime": utc_datetime(date, 9, 30)},
+                {"dateTime": utc_datetime(date, 9, 45)}, attendees=6)
+        remaining = self.events_per_person - len(self.dates)
+        weeks = max(1, len(self.dates) // 5)
+        for _ in range(max(0, remaining * 3 // 10 // weeks)):
+            weekday = rng.randint(0, 4)
+            hour = rng.randint(9, 16)
+            length = rng.choice([30, 60])
+            summary = rng.choice(meeting_summaries)
+            attendees = rng.randint(1, 8)
+            for date in self.dates:
+                if date.weekday() == weekday:
+                    add(summary, {"dateTime": utc_datetime(date, hour, 0)},
+                        {"dateTime": utc_datetime(date, hour + length // 60,
+                                                  length % 60)},
+                        attendees=attendees)
+
+        # One-off meetings.
+        for _ in range(max(0, self.events_per_person - len(events))):
+            date = rng.choice(self.dates)
+            hour = rng.randint(9, 16)
+            minute = rng.choice([0, 30])
+            length = rng.choice([30, 60, 90])
+            end_minutes = hour * 60 + minute + length
+            add(rng.choice(meeting_summaries),
+                {"dateTime": utc_datetime(date, hour, minute)},
+                {"dateTime": utc_datetime(date, end_minutes // 60,
+                                          end_minutes % 60)},
+                attendees=rng.randint(1, 8),
+                transparent=rng.random() < 0.1)
+
+        # Leave, as all-day busy events.
+        if rng.random() < 0.3:
+            start = rng.choice(self.dates)
+            end = start + datetime.timedelta(days=rng.randint(1, 10))
+            add(rng.choice(leave_summaries), {"date": start.isoformat()},
+                {"date": end.isoformat()})
+
+        # Out of office markers, which usually aren't marked as busy.
+        for _ in range(rng.choice([0, 0, 1, 2, 4])):
+            date = rng.choice(self.dates)
+            add(rng.choice(out_of_office_summaries),
+                {"date": date.isoformat()},
+                {"date": (date + datetime.timedelta(days=1)).isoformat()},
+                transparent=True)
+
+        # Preferred interview slot markers, on the same day each week.
+        if rng.random() < 0.15:
+            weekday = rng.randint(0, 4)
+            for date in self.dates:
+                if date.weekday() == weekday:
+                    add("Preferred interview slot",
+                        {"dateTime": utc_datetime(date, 9, 0)},
+                        {"dateTime": utc_datetime(date, 17, 0)},
+                        transparent=True)
+
+        return events
+
+    def _slot_times(self):
+        for date in self.dates:
+            for time in ("10:15", "14:15"):
+                yield date, time
+
+    def _booked_events(self):
+        """Generate events for the past slots which were booked, in the form
+        returned by the calendar API.
+
+        """
+        rng = self.rng
+        emails = sorted(row["email"] for row in self.rows)
+        events = []
+        for date, time in self._slot_times():
+            if date >= self.min_new_slot_date or rng.random() >= 0.8:
+                continue
+            slot = Slot(date, time, 150, False)
+            events.append({
+                "id": "booked{}".format(len(events)),
+                "start": {"dateTime": slot.start.isoformat()},
+                "end": {"dateTime": slot.end.isoformat()},
+                "summary": rng.choice([
+                    "Interview placeholder", "Interview: candidate",
+                ]),
+                "attendees": [
+                    {"email": email, "responseStatus": "accepted"}
+                    for email in rng.sample(emails, min(3, len(emails)))
+                ],
+            })
+        return events
+
+    def write_csv(self, path):
+        """Write the interviewers to a CSV file, as read by Interviewers."""
+        with open(path, "wb") as fobj:
+            writer = csv.DictWriter(fobj, interviewer_fields)
+            writer.writeheader()
+            for row in self.rows:
+                writer.writerow(row)
+
+    def write_calendar_cache(self, cache_dir):
+        """Write the calendars to a directory in the format used by
+        CalendarCache.
+
+        """
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        date_min = self.date_min.isoformat() + "T00:00:00Z"
+        date_max = self.date_max.isoformat() + "T00:00:00Z"
+        for email, events in self.events.items():
+            slug = re.sub("[^a-z0-9]", "_", email.lower())
+            with open(os.path.join(cache_dir, slug + ".json"), "wb") as fobj:
+                json.dump({
+                    "date_min": date_min,
+                    "date_max": date_max,
+                    "data": events,
+                }, fobj)
+
+    def interviewers(self, csv_path):
+        """Write the interviewers CSV, and load it with their calendars."""
+        self.write_csv(csv_path)
+        interviewers = Interviewers.from_csv(csv_path)
+        for interviewer in interviewers:
+            interviewer.calendar = Calendar(interviewer.email, [
+                Event(event, True, interviewer.email)
+                for event in self.events[interviewer.email]
+            ])
+        return interviewers
+
+    def slots(self):
+        """Make the slots, with past ones associated with booked events."""
+        booked = dict(
+            (event["start"]["dateTime"], event)
+            for event in self.booked
+        )
+        slots = []
+        for date, time in self._slot_times():
+            slot = Slot(date, time, 150, date >= self.min_new_slot_date)
+            if slot.new:
+                slot.event = SlotGenerator.make_placeholder_event(slot)
+            elif slot.start.isoformat() in booked:
+                slot.event = Event(booked[slot.start.isoformat()], True)
+            slots.append(slot)
+        return slots
+
+    @staticmethod
+    def assignments(slots, interviewers):
+        return SlotAssignments(
+            SlotAssignment(slot, interviewers)
+            for slot in slots
+        )
@@ -0,0 +1,97 @@
+"""Count the requests made to google APIs, and the data received.
+
+"""
+
+import threading
+
+
+class TrafficCounter(object):
+    """Counts of requests and responses, which may be shared between
+    threads.
+
+    """
+    def __init__(self):
+        self.requests = 0
+        self.api_calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+        self.not_modified = 0
+        self.bytes_received = 0
+        self.compressed_responses = 0
+        self._lock = threading.Lock()
+
+    def wrap_http(self, http):
+        """Make an http object count its requests, in the same way that
+        oauth2client wraps it to add authorization.
+
+        httplib2 decompresses responses before returning them, so the bytes
+        counted are those of the decompressed content.
+
+        """
+        request = http.request
+
+        def count_request(uri, method="GET", *args, **kwargs):
+            resp, content = request(uri, method, *args, **kwargs)
+            with self._lock:
+                self.requests += 1
+                self.bytes_received += len(content or "")
+                if "-content-encoding" in resp:
+                    self.compressed_responses += 1
+            return resp, content
+
+        if hasattr(request, "credentials"):
+            count_request.credentials = request.credentials
+        http.request = count_request
+        return http
+
+    def count_api_calls(self, count):
+        """Count API calls, several of which may be made in one batch
+        request.
+
+        """
+        with self._lock:
+            self.api_calls += count
+
+    def count_error(self, throttled):
+        """Count an API call which failed.
+
+        :param throttled: True if it was refused by a rate limit.
+
+        """
+        with self._lock:
+            self.errors += 1
+            if throttled:
+                self.throttled += 1
+
+    def count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def count_not_modified(self):
+        """Count an API call answered with "not modified"."""
+        with self._lock:
+            self.not_modified += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "api_calls": self.api_calls,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "not_modified": self.not_modified,
+                "bytes_received": self.bytes_received,
+                "compressed_responses": self.compressed_responses,
+            }
+
+    def __str__(self):
+        stats = self.stats()
+        return (
+            "{requests} requests ({api_calls} API calls, {errors} failed, "
+            "{throttled} by rate limits, {retries} retried, {not_modified} "
+            "not modified), receiving "
+            "{bytes_received} bytes; {compressed_responses} responses were "
+            "compressed".format(**stats)
+        )